@@ -0,0 +1,58 @@
+import asyncio
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from telebot.async_telebot import AsyncTeleBot
+
+from bot.bot import COMMANDS, TOKEN, find_handler, run_collected, send_collected
+from bot.sharding import message_chat_id, shard_map
+from bot.storage import storage
+
+abot = AsyncTeleBot(TOKEN)
+
+# One lock per chat with an update in progress, so that a chat's updates run
+# one at a time as in the ingest pool; they share the cached Queue instance.
+_chat_locks = weakref.WeakValueDictionary()
+
+
+def _in_thread(func, *args):
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def in_database(func, *args):
+    return await sync_to_async(_in_thread, thread_sensitive=False)(func, *args)
+
+
+def _collect(handler, update):
+    with storage.handling(update) as duplicate:
+        return [] if duplicate else run_collected(handler, update.message)
+
+
+def _async_handler(handler):
+    # The command logic and its ORM calls run in a worker thread exactly as in
+    # the sync bot. The Telegram calls it collected go to the dispatcher once
+    # the update has been recorded as handled.
+    async def wrapper(update):
+        send_collected(await in_database(_collect, handler, update))
+    return wrapper
+
+
+_wrappers = {handler: _async_handler(handler) for handler in set(COMMANDS.values())}
+
+
+async def process_update(update):
+    chat_id = message_chat_id(update)
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    async with lock:
+        with shard_map.using(chat_id):
+            await in_database(storage.remember_update, update)
+            _, handler = find_handler(update)
+            if handler is not None:
+                await _wrappers[handler](update)
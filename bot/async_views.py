@@ -0,0 +1,34 @@
+import json
+import os
+import telebot
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from bot.async_bot import abot, process_update
+from bot.fast_views import has_secret
+from bot.sharding import message_chat_id, shard_map
+
+
+@csrf_exempt
+async def webhook(request, token):
+    if request.method == 'GET':
+        try:
+            await abot.remove_webhook()
+            await abot.set_webhook(f"{os.getenv('APP_URL')}/{token}", secret_token=settings.WEBHOOK_SECRET or None)
+            return HttpResponse('Webhook was successfully set.')
+        except Exception as e:
+            return HttpResponse(str(e))
+
+    elif request.method == 'POST':
+        if not has_secret(request):
+            return HttpResponseForbidden()
+        update = telebot.types.Update.de_json(json.loads(request.body))
+        url = shard_map.forward_url(message_chat_id(update))
+        if url is not None:
+            status = await sync_to_async(shard_map.forward, thread_sensitive=False)(url, request.body)
+            return HttpResponse(status=status)
+        await process_update(update)
+        return HttpResponse('!')
+
+    return HttpResponse(status=405)
@@ -1,12 +1,185 @@
+import logging
 import os
-from datetime import timedelta
-from telebot import TeleBot
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import time, timedelta
+from telebot import TeleBot, apihelper
 from telebot.types import Message
+from bot.cache import ChatAdminCache
+from bot.coalescer import EditCoalescer
+from bot.dispatcher import REFRESH, REPLY, SendDispatcher
+from bot.metrics import profile_update
 from bot.models import Queue
-from django.utils import timezone
+from bot.ratelimit import cooldowns
+from bot.render import QueueRenderer
+from bot.routers import read_only
+from bot.sharding import current_shard, message_chat_id, shard_map
+from bot.storage import storage
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class CommandError(Exception):
+    pass
+
 
 TOKEN = os.getenv('TOKEN')
-bot = TeleBot(TOKEN)
+apihelper.SESSION_TIME_TO_LIVE = settings.TELEGRAM_SESSION_TTL
+_bot = None
+_bot_lock = threading.Lock()
+
+# Command name -> handler, shared by the sync bot and bot/async_bot.py.
+# Updates are routed through this table by process_update() rather than by
+# TeleBot's handler list.
+COMMANDS = {}
+
+
+def get_bot():
+    # Built on first use, so that importing the handlers stays cheap and
+    # forked workers do not inherit a bot from the master process.
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                _bot = TeleBot(TOKEN, threaded=False)
+    return _bot
+
+
+dispatcher = SendDispatcher(get_bot,
+                            senders=settings.TELEGRAM_SENDERS,
+                            global_rate=settings.TELEGRAM_GLOBAL_RATE,
+                            global_burst=settings.TELEGRAM_GLOBAL_BURST,
+                            chat_rate=settings.TELEGRAM_CHAT_RATE,
+                            chat_burst=settings.TELEGRAM_CHAT_BURST)
+
+# Asked directly rather than through the dispatcher: the handler needs the
+# answer, and reads do not count against the chat's sending limit.
+chat_admins = ChatAdminCache(lambda chat_id: get_bot().get_chat_administrators(chat_id),
+                             ttl=settings.CHAT_ADMINS_TTL)
+
+# Outgoing API calls are collected here instead of being sent when the
+# handler runs inside collected()
+_outbox = ContextVar('outbox', default=None)
+
+
+def command(*names):
+    def decorator(handler):
+        for name in names:
+            COMMANDS[name] = handler
+        return handler
+    return decorator
+
+
+def parse_command(text, bot_username=None):
+    # '/add@QueueBot @a @b' -> 'add'. None if the text is not a command, or is
+    # a command addressed to another bot.
+    if not text or text[0] != '/':
+        return None
+    name, _, addressee = text.split(maxsplit=1)[0][1:].partition('@')
+    if addressee and bot_username and addressee.lower() != bot_username.lower():
+        return None
+    return name.lower()
+
+
+def find_handler(update):
+    msg = update.message
+    if msg is None or msg.content_type != 'text':
+        return None, None
+    name = parse_command(msg.text, settings.BOT_USERNAME)
+    return name, COMMANDS.get(name)
+
+
+def process_update(update):
+    with shard_map.using(message_chat_id(update)):
+        # Every update feeds the user directory, which only writes for new or
+        # renamed users; anything that is not one of our commands stops here.
+        storage.remember_update(update)
+        name, handler = find_handler(update)
+        if handler is None:
+            return
+        with storage.handling(update) as duplicate:
+            if duplicate:
+                return
+            with profile_update(name):
+                try:
+                    handler(update.message)
+                except CommandError:
+                    pass
+
+
+@contextmanager
+def collected():
+    """Collects the Telegram calls made inside instead of sending them."""
+    outbox = []
+    token = _outbox.set(outbox)
+    try:
+        yield outbox
+    finally:
+        _outbox.reset(token)
+
+
+def run_collected(handler, msg):
+    with collected() as outbox:
+        try:
+            handler(msg)
+        except CommandError:
+            pass
+    return outbox
+
+
+def send_collected(outbox):
+    """Sends the calls collected by collected() through the dispatcher."""
+    for method, args, chat_id, priority, callback in outbox:
+        try:
+            _send(method, *args, chat_id=chat_id, priority=priority, callback=callback)
+        except Exception:
+            logger.exception('Could not send %s to chat %s.', method, chat_id)
+
+
+def _send(method, *args, chat_id, priority=REPLY, callback=None):
+    outbox = _outbox.get()
+    if outbox is not None:
+        outbox.append((method, args, chat_id, priority, callback))
+        return
+    sent = dispatcher.submit(method, *args, chat_id=chat_id, priority=priority)
+    if callback is not None:
+        sent.add_done_callback(_when_sent(callback))
+
+
+def _when_sent(callback):
+    # The handler does not wait for the dispatcher: callback runs on the
+    # sender thread once the call succeeded, in the shard of the update.
+    shard = current_shard.get()
+
+    def done(sent):
+        if sent.exception() is not None:
+            return
+        token = current_shard.set(shard)
+        close_old_connections()
+        try:
+            callback(sent.result())
+        except Exception:
+            logger.exception('Callback after a Telegram call failed.')
+        finally:
+            close_old_connections()
+            current_shard.reset(token)
+    return done
+
+
+def _reply(msg, text, callback=None):
+    _send('reply_to', msg, text, chat_id=msg.chat.id, callback=callback)
+
+
+def _edit(text, chat_id, message_id):
+    # Called by edit_coalescer's thread, never collected
+    return dispatcher.submit('edit_message_text', text, chat_id, message_id, chat_id=chat_id, priority=REFRESH)
+
+
+edit_coalescer = EditCoalescer(_edit, settings.EDIT_DEBOUNCE)
+renderer = QueueRenderer()
 
 INFO_EN = 'Hello, I am Queue Bot. I was made to manage queues in group chats. There is only one /queue per chat. Use ' \
           '/enter or /leave to manage your presence in the queue. ' \
@@ -14,7 +187,8 @@ INFO_EN = 'Hello, I am Queue Bot. I was made to manage queues in group chats. Th
           'Admins can /add to or /remove from the queue. ' \
           'You can also know /who is first and /where are you in the queue. ' \
           'Admins can use /promote or /demote to manage permissions. ' \
-          'Admins can also /activate and /deactivate the queue. ' \
+          'Admins can also /activate and /deactivate the queue ' \
+          'and /schedule a daily reset at HH:MM UTC. ' \
           'If the queue is deactivated users cannot enter or leave ' \
           'the queue by themselves.\n\n ' \
           'Report any problems to @Jiklopo.'
@@ -24,299 +198,328 @@ INFO_RU = 'Я создан, чтобы поддерживать очередь 
           'Также в очереди есть админы, которые могут добавлять людей(/add @username1 @username2...) ' \
           'или удалять людей(/remove @username1 @username2...), ' \
           'добавлять админов(/promote @username1 @username2...) и удалять админов(/demote @username1 @username2...), ' \
-          'а также деактивировать(/deactivate) или активировать(/activate) очередь. ' \
+          'а также деактивировать(/deactivate) или активировать(/activate) очередь ' \
+          'и настроить ежедневный сброс очереди(/schedule ЧЧ:ММ по UTC или /schedule off). ' \
           'В деактивированную очередь нельзя войти, а также из нее нельзя выйти самостоятельно.\n\n' \
           'Если возникнут какие-либо проблемы, пишите @Jiklopo.'
 
 
 def _get_queue(msg: Message, bypass=True):
     MESSAGE = 'Queue is deactivated. Only admins can add new people.'
-    class QueueDeactivatedException(Exception):
+    class QueueDeactivatedException(CommandError):
         pass
 
-    try:
-        q = Queue.objects.get(chat_id=msg.chat.id)
-        if not bypass and not q.is_active and not q.is_admin(msg.from_user.username):
-            bot.reply_to(msg, MESSAGE)
-            raise QueueDeactivatedException
-    except Queue.DoesNotExist:
-        q = Queue.objects.create(chat_id=msg.chat.id,
-                                 name=msg.chat.title,
-                                 users=[],
-                                 admins=['Jiklopo', msg.from_user.username or ""])
+    q = storage.get(msg.chat.id)
+    if q is None:
+        return storage.create(msg.chat.id, msg.chat.title, ['Jiklopo', msg.from_user.username or ""])
+    q.touch()
+    if not bypass and not q.is_active and not _has_admin_rights(msg, q):
+        _reply(msg, MESSAGE)
+        raise QueueDeactivatedException
     return q
 
 
 def _bad_chat(msg):
     MESSAGE = 'I work only in group chats.'
-    class NotGroupException(Exception):
+    class NotGroupException(CommandError):
         pass
 
     if msg.chat.type.find('group') == -1:
-        bot.reply_to(msg, MESSAGE)
+        _reply(msg, MESSAGE)
         raise NotGroupException
 
 
+def _has_admin_rights(msg, q: Queue):
+    if q.is_admin(msg.from_user.username):
+        return True
+    return settings.TRUST_CHAT_ADMINS and msg.from_user.id in chat_admins.get(msg.chat.id)
+
+
 def _is_admin(msg):
     MESSAGE = 'You must have admin permissions for this action.'
-    class NoAdminPermissionsException(Exception):
+    class NoAdminPermissionsException(CommandError):
         pass
 
     q = _get_queue(msg)
-    if not q.is_admin(msg.from_user.username):
-        bot.reply_to(msg, MESSAGE)
+    if not _has_admin_rights(msg, q):
+        _reply(msg, MESSAGE)
         raise NoAdminPermissionsException
     return q
 
 
-def _get_users(msg):
-    class NoMentionsException(Exception):
+def _get_mentions(msg):
+    class NoMentionsException(CommandError):
         pass
 
-    users = []
-    for e in msg.entities:
-        if e.type == 'mention':
-            ofs = e.offset + 1 if msg.text[e.offset] == '@' else 0
-            users.append(msg.text[ofs:ofs + e.length])
-    if len(users) == 0:
-        bot.reply_to(msg, 'You have to mention users for this action.')
+    mentions = [e for e in msg.entities or () if e.type in ('mention', 'text_mention')]
+    if len(mentions) == 0:
+        _reply(msg, 'You have to mention users for this action.')
         raise NoMentionsException
-    return users
+    return mentions
+
+
+def _mentioned_name(msg, e):
+    return e.user.username if e.type == 'text_mention' else msg.text[e.offset + 1:e.offset + e.length]
+
+
+def _get_users(msg):
+    mentions = _get_mentions(msg)
+    ids = iter(storage.resolve([_mentioned_name(msg, e) for e in mentions if e.type == 'mention']))
+    return [e.user.id if e.type == 'text_mention' else next(ids) for e in mentions]
+
+
+def _change_users(msg, change):
+    # Placeholder ids cached by this worker may have been claimed by their
+    # user or dropped since; those mentions are resolved again and retried.
+    users = _get_users(msg)
+    results = change(users)
+    missed = [user for user, done in zip(users, results) if not done]
+    if missed and storage.forget_missing(missed):
+        results = [done or retried for done, retried in zip(results, change(_get_users(msg)))]
+    return results
+
+
+def _get_usernames(msg):
+    # Queue admins are still kept by username
+    return [name for name in (_mentioned_name(msg, e) for e in _get_mentions(msg)) if name]
 
 
 def _empty_queue(msg, q=None):
-    class EmptyQueueException(Exception):
+    class EmptyQueueException(CommandError):
         pass
 
     if q is None:
         q = _get_queue(msg)
 
-    if len(q.users) == 0:
-        bot.reply_to(msg, 'There are no users in the queue.')
+    if q.user_count() == 0:
+        _reply(msg, 'There are no users in the queue.')
         raise EmptyQueueException
     return q
 
 
-def _check_timestamp(msg, timestamp, cooldown):
-    MESSAGE = f'Please respect others, do not mention people too often. You have to wait for {cooldown} seconds between commands.'
-    class CooldownException(Exception):
+def _check_cooldown(msg, q: Queue, name):
+    MESSAGE = f'Please respect others, do not mention people too often. You have to wait for {q.cooldown} seconds between commands.'
+    class CooldownException(CommandError):
         pass
 
-    td = timezone.now() - timestamp
-    if td.total_seconds() < cooldown:
-        bot.reply_to(msg, MESSAGE)
+    if not cooldowns.acquire(q.chat_id, name, q.cooldown):
+        _reply(msg, MESSAGE)
         raise CooldownException
 
 
-def _get_queue_text(q: Queue):
-    status = f'The queue is {"de" if not q.is_active else ""}activated'
-    status += f'. There are {len(q.users)} user(s) in the queue:\n' if len(q.users) > 0 else ' and empty.'
-    for i, u in enumerate(q.users):
-        status += f'{i + 1}. @{u}\n'
-    return status
+def _get_queue_pages(q: Queue):
+    return renderer.render(q.chat_id, q.is_active, q.users)
+
+
+def _send_page(q: Queue, page):
+    _send('send_message', q.chat_id, page, chat_id=q.chat_id,
+          callback=lambda sent: q.update_message_ids(q.message_ids + [sent.message_id]))
 
 
 def _update_message(q: Queue):
-    bot.edit_message_text(_get_queue_text(q), q.chat_id, q.message_id)
+    if not q.message_ids:
+        return
+    pages = _get_queue_pages(q)
+    for i, message_id in enumerate(q.message_ids):
+        edit_coalescer.mark(q.chat_id, message_id, pages[i] if i < len(pages) else 'The rest of the queue is empty.')
+    for page in pages[len(q.message_ids):]:
+        _send_page(q, page)
 
 
-@bot.message_handler(commands=['help', 'info', 'information', 'start'])
+@command('help', 'info', 'information', 'start')
 def help_en(msg):
     global INFO_EN
-    bot.reply_to(msg, INFO_EN)
+    _reply(msg, INFO_EN)
 
 
-@bot.message_handler(commands=['help_ru'])
+@command('help_ru')
 def help_ru(msg):
     global INFO_RU
-    bot.reply_to(msg, INFO_RU)
+    _reply(msg, INFO_RU)
 
 
-@bot.message_handler(commands=['queue', 'status'])
+@command('queue', 'status')
+@read_only
 def status(msg):
     _bad_chat(msg)
     q = _get_queue(msg)
-    _check_timestamp(msg, q.list_timestamp, q.cooldown)
     _empty_queue(msg, q)
-    new_msg = bot.reply_to(msg, _get_queue_text(q))
-    q.update_message_id(new_msg.message_id)
-    q.list_timestamp = timezone.now()
-    q.save()
+    _check_cooldown(msg, q, 'queue')
+    pages = _get_queue_pages(q)
+    _reply(msg, pages[0], callback=lambda sent: q.update_message_ids([sent.message_id]))
+    for page in pages[1:]:
+        _send_page(q, page)
 
 
-@bot.message_handler(commands=['admins'])
+@command('admins')
+@read_only
 def admins(msg):
     _bad_chat(msg)
     q = _get_queue(msg)
-    _check_timestamp(msg, q.admins_timestamp, q.cooldown)
+    _check_cooldown(msg, q, 'admins')
     reply = f'Admins of {q.name}:\n'
     for i, admin in enumerate(q.admins):
         reply += f'{i + 1}. @{admin}\n'
-    bot.reply_to(msg, reply)
-    q.admins_timestamp = timezone.now()
-    q.save()
+    _reply(msg, reply)
 
 
-@bot.message_handler(commands=['who'])
+@command('who')
+@read_only
 def who(msg):
     _bad_chat(msg)
     q = _get_queue(msg)
     _empty_queue(msg, q)
-    _check_timestamp(msg, q.who_timestamp, q.cooldown)
-    bot.reply_to(msg, f'@{q.users[0]} is the first.')
-    q.who_timestamp = timezone.now()
-    q.save()
+    _check_cooldown(msg, q, 'who')
+    _reply(msg, f'{q.first_user()} is the first.')
 
 
-@bot.message_handler(commands=['where'])
+@command('where')
+@read_only
 def where(msg):
     _bad_chat(msg)
     q = _get_queue(msg)
-    try:
-        pos = q.users.index(msg.from_user.username)
-        bot.reply_to(msg, f'Your position is {pos + 1}')
-    except ValueError:
-        bot.reply_to(msg, 'You are not in the queue.')
+    pos = q.position_of(msg.from_user.id)
+    if pos is None:
+        _reply(msg, 'You are not in the queue.')
+    else:
+        _reply(msg, f'Your position is {pos}')
 
 
-@bot.message_handler(commands=['enter'])
+@command('enter')
 def enter(msg):
     _bad_chat(msg)
     q = _get_queue(msg, bypass=False)
-    if q.add_user(username=msg.from_user.username):
-        bot.reply_to(msg, f'You are now in the queue! Your position is {len(q.users)}.')
+    if q.add_user(msg.from_user.id):
+        _reply(msg, f'You are now in the queue! Your position is {q.position_of(msg.from_user.id)}.')
     else:
-        bot.reply_to(msg, 'You are already in the queue.')
+        _reply(msg, 'You are already in the queue.')
     _update_message(q)
 
 
-@bot.message_handler(commands=['leave'])
+@command('leave')
 def leave(msg):
     _bad_chat(msg)
     q = _get_queue(msg, bypass=False)
-    if q.remove_user(msg.from_user.username):
-        bot.reply_to(msg, 'You have successfully left the queue')
+    if q.remove_user(msg.from_user.id):
+        _reply(msg, 'You have successfully left the queue')
     else:
-        bot.reply_to(msg, 'You are not in the queue.')
+        _reply(msg, 'You are not in the queue.')
     _update_message(q)
 
 
-@bot.message_handler(commands=['add'])
+@command('add')
 def add(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    users = _get_users(msg)
-    not_added = 0
-    for u in users:
-        not_added += 0 if q.add_user(u) else 1
+    results = _change_users(msg, q.add_users)
+    not_added = results.count(False)
 
     if not_added == 0:
-        bot.reply_to(msg, 'Successfully added everybody mentioned.')
-    elif not_added == len(users):
-        bot.reply_to(msg, 'These users are already in the queue.')
+        _reply(msg, 'Successfully added everybody mentioned.')
+    elif not_added == len(results):
+        _reply(msg, 'These users are already in the queue.')
     else:
-        bot.reply_to(msg, f'Some users [{not_added}] have already been present in the queue. Added everyone else.')
+        _reply(msg, f'Some users [{not_added}] have already been present in the queue. Added everyone else.')
     _update_message(q)
 
 
-@bot.message_handler(commands=['remove'])
+@command('remove')
 def remove(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    users = _get_users(msg)
-
-    not_removed = 0
-    for u in users:
-        not_removed += 0 if q.remove_user(u) else 1
+    results = _change_users(msg, q.remove_users)
+    not_removed = results.count(False)
 
     if not_removed == 0:
-        bot.reply_to(msg, 'Successfully removed everybody mentioned.')
-    elif not_removed == len(users):
-        bot.reply_to(msg, 'There are no such user(s) in the queue.')
+        _reply(msg, 'Successfully removed everybody mentioned.')
+    elif not_removed == len(results):
+        _reply(msg, 'There are no such user(s) in the queue.')
     else:
-        bot.reply_to(msg, f'Some users [{not_removed}] have not been present in the queue. Removed everyone else.')
+        _reply(msg, f'Some users [{not_removed}] have not been present in the queue. Removed everyone else.')
     _update_message(q)
 
 
-@bot.message_handler(commands=['pop'])
+@command('pop')
 def pop(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
     _empty_queue(msg, q)
-    username = q.users[0]
-    del q.users[0]
-    q.save()
-    bot.reply_to(msg, f'@{username} is now not in the queue.')
+    name = q.pop_user()
+    _reply(msg, f'{name} is now not in the queue.')
     _update_message(q)
 
 
-@bot.message_handler(commands=['activate'])
+@command('activate')
 def activate(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    if q.is_active:
-        bot.reply_to(msg, 'Queue is already active.')
+    if not q.set_active(True):
+        _reply(msg, 'Queue is already active.')
     else:
-        q.is_active = True
-        q.save()
-        bot.reply_to(msg, 'Successfully activated the queue.')
+        _reply(msg, 'Successfully activated the queue.')
     _update_message(q)
 
 
-@bot.message_handler(commands=['deactivate'])
+@command('deactivate')
 def deactivate(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    if not q.is_active:
-        bot.reply_to(msg, 'Queue is already deactivated.')
+    if not q.set_active(False):
+        _reply(msg, 'Queue is already deactivated.')
     else:
-        q.is_active = False
-        q.save()
-        bot.reply_to(msg, 'Successfully deactivated the queue.')
+        _reply(msg, 'Successfully deactivated the queue.')
 
 
-@bot.message_handler(commands=['promote'])
+@command('promote')
 def promote(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    users = _get_users(msg)
+    users = _get_usernames(msg)
+    cnt = q.add_admins(users).count(True)
 
-    cnt = 0
-    for u in users:
-        cnt += 1 if q.add_admin(u) else 0
+    _reply(msg, f'Added {cnt} new admins.')
 
-    bot.reply_to(msg, f'Added {cnt} new admins.')
 
-
-@bot.message_handler(commands=['demote'])
+@command('demote')
 def demote(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    users = _get_users(msg)
-    cnt = 0
-
-    for u in users:
-        cnt += 1 if q.remove_admin(u) else 0
+    users = _get_usernames(msg)
+    cnt = q.remove_admins(users).count(True)
 
-    bot.reply_to(msg, f'Removed {cnt} admins.')
+    _reply(msg, f'Removed {cnt} admins.')
 
 
-@bot.message_handler(commands=['reset', 'restart'])
+@command('reset', 'restart')
 def reset(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
-    q.users = []
-    q.save()
-    bot.reply_to(msg, f'Queue reset.')
+    q.clear()
+    _reply(msg, f'Queue reset.')
 
 
-@bot.message_handler(commands=['cooldown'])
+@command('cooldown')
 def cooldown(msg):
     _bad_chat(msg)
     q = _is_admin(msg)
     try:
-        q.cooldown = int(msg.text.split()[1])
-        q.save()
-        bot.reply_to(msg, f'Cooldown set to {q.cooldown}')
+        q.set_cooldown(int(msg.text.split()[1]))
+        _reply(msg, f'Cooldown set to {q.cooldown}')
+    except (ValueError, IndexError):
+        _reply(msg, 'You have to provide an integer value.')
+
+
+@command('schedule')
+def schedule(msg):
+    _bad_chat(msg)
+    q = _is_admin(msg)
+    try:
+        arg = msg.text.split()[1]
+        if arg == 'off':
+            q.set_reset_time(None)
+            _reply(msg, 'The queue will not be reset automatically.')
+        else:
+            q.set_reset_time(time.fromisoformat(arg))
+            _reply(msg, f'The queue will be reset every day at {q.reset_time:%H:%M} UTC.')
     except (ValueError, IndexError):
-        bot.reply_to(msg, 'You have to provide an integer value.')
+        _reply(msg, 'You have to provide a time as HH:MM (UTC) or off.')
@@ -0,0 +1,169 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from bot.routers import recent_writes
+from bot.sharding import current_shard
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'bot_queue'
+
+
+class QueueCache:
+    """LRU cache of Queue instances keyed by chat_id.
+
+    Model methods write through by calling store() with the instance they have
+    just changed. Changes made by other processes arrive as NOTIFY events sent
+    by the triggers from migration 0006 and evict the affected chat. There is
+    one listener for each database (shard) in aliases.
+    """
+
+    def __init__(self, size, ttl, listen, aliases=(DEFAULT_DB_ALIAS,)):
+        self.size = size
+        self.ttl = ttl
+        self.listen = listen
+        self.aliases = list(aliases)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # (alias, backend pid) -> our psycopg2 connection with that pid. A pid
+        # only counts as ours while the connection is open, since PostgreSQL
+        # reuses the pids of closed backends.
+        self._own = {}
+        self._listeners = None
+
+    def get(self, chat_id):
+        self._start_listener()
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(chat_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+
+    def store(self, queue):
+        if self.size <= 0:
+            return
+        alias = current_shard.get()
+        conn = connections[alias].connection
+        with self._lock:
+            if self.listen and conn is not None and not conn.closed:
+                key = (alias, conn.info.backend_pid)
+                if self._own.get(key) is not conn:
+                    self._own = {own: c for own, c in self._own.items() if not c.closed}
+                    self._own[key] = conn
+            self._entries[queue.chat_id] = (queue, time.monotonic() + self.ttl)
+            self._entries.move_to_end(queue.chat_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, chat_id=None):
+        with self._lock:
+            if chat_id is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+            elif self._entries.pop(chat_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _start_listener(self):
+        if not self.listen or self.size <= 0 or self._listeners is not None:
+            return
+        with self._lock:
+            if self._listeners is None:
+                self._listeners = [threading.Thread(target=self._listen, args=(alias,),
+                                                    name=f'queue-cache-listener-{alias}', daemon=True)
+                                   for alias in self.aliases]
+                for listener in self._listeners:
+                    listener.start()
+
+    def _listen(self, alias):
+        while True:
+            try:
+                conn = self._connect(alias)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CHANNEL}')
+                # Anything could have changed while we were not listening.
+                self.invalidate()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._handle(alias, conn.notifies.pop(0).payload)
+            except psycopg2.Error:
+                logger.exception('Queue cache listener lost its connection.')
+                self.invalidate()
+                time.sleep(5)
+
+    def _connect(self, alias):
+        # A direct connection of our own: LISTEN needs a session that outlives
+        # transactions, which pooled or PgBouncer connections do not give.
+        database = settings.DATABASES[alias]
+        return psycopg2.connect(dbname=database['NAME'], user=database['USER'], password=database['PASSWORD'],
+                                host=database['HOST'], port=database['PORT'],
+                                sslmode=database.get('OPTIONS', {}).get('sslmode', 'prefer'))
+
+    def _handle(self, alias, payload):
+        chat_id, pid = payload.split()
+        # Our own writes have already been applied to the cached instance.
+        with self._lock:
+            conn = self._own.get((alias, int(pid)))
+        if conn is None or conn.closed:
+            recent_writes.mark(int(chat_id))
+            self.invalidate(int(chat_id))
+
+
+class ChatAdminCache:
+    """User ids of each chat's Telegram administrators, kept for ttl seconds."""
+
+    def __init__(self, fetch, ttl, size=1000):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(chat_id)
+                return entry[0]
+        admins = frozenset(member.user.id for member in self.fetch(chat_id))
+        with self._lock:
+            self._entries[chat_id] = (admins, time.monotonic() + self.ttl)
+            self._entries.move_to_end(chat_id)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return admins
+
+
+queue_cache = QueueCache(size=getattr(settings, 'QUEUE_CACHE_SIZE', 1000),
+                         ttl=getattr(settings, 'QUEUE_CACHE_TTL', 60),
+                         listen=getattr(settings, 'QUEUE_CACHE_LISTEN', True),
+                         aliases=getattr(settings, 'SHARD_LOCAL', None) or getattr(settings, 'SHARDS', [DEFAULT_DB_ALIAS]))
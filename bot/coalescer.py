@@ -0,0 +1,99 @@
+import atexit
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+
+class EditCoalescer:
+    """Debounces edits of the queue list message.
+
+    mark() records the latest text for a message; the text is sent once the
+    window has passed, so a burst of changes results in a single edit. edit
+    returns a future for the call; retries after 429s are left to the
+    dispatcher behind it.
+    """
+
+    def __init__(self, edit, window, remember=10000):
+        self.edit = edit
+        self.window = window
+        self.remember = remember
+        self.marked = 0
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self._pending = {}
+        self._last_sent = OrderedDict()
+        self._due = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def mark(self, chat_id, message_id, text):
+        key = (chat_id, message_id)
+        with self._cond:
+            self.marked += 1
+            if key not in self._pending:
+                heapq.heappush(self._due, (time.monotonic() + self.window, key))
+            self._pending[key] = text
+            self._start()
+            self._cond.notify()
+
+    def flush(self):
+        with self._cond:
+            pending, self._pending = self._pending, {}
+            self._due = []
+        for (chat_id, message_id), text in pending.items():
+            self._send(chat_id, message_id, text)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'marked': self.marked,
+                'sent': self.sent,
+                'skipped': self.skipped,
+                'failed': self.failed,
+            }
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='edit-coalescer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if not self._due:
+                    self._cond.wait()
+                elif self._due[0][0] > now:
+                    self._cond.wait(self._due[0][0] - now)
+                else:
+                    _, key = heapq.heappop(self._due)
+                    if key in self._pending:
+                        return key + (self._pending.pop(key),)
+
+    def _run(self):
+        while True:
+            self._send(*self._next())
+
+    def _send(self, chat_id, message_id, text):
+        key = (chat_id, message_id)
+        with self._cond:
+            if self._last_sent.get(key) == text:
+                self.skipped += 1
+                return
+        self.edit(text, chat_id, message_id).add_done_callback(lambda sent: self._sent(key, text, sent))
+
+    def _sent(self, key, text, sent):
+        # Only a successful edit counts, so a failed text is sent again
+        with self._cond:
+            if sent.exception() is not None:
+                self.failed += 1
+                return
+            self.sent += 1
+            self._last_sent[key] = text
+            self._last_sent.move_to_end(key)
+            if len(self._last_sent) > self.remember:
+                self._last_sent.popitem(last=False)
@@ -0,0 +1,19 @@
+import threading
+
+from django.db.backends.signals import connection_created
+
+_lock = threading.Lock()
+_opened = 0
+
+
+def _connection_created(sender, connection, **kwargs):
+    global _opened
+    with _lock:
+        _opened += 1
+
+
+connection_created.connect(_connection_created)
+
+
+def db_stats():
+    return {'connections_opened': _opened}
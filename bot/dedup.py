@@ -0,0 +1,74 @@
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.db import transaction
+
+from bot.models import ProcessedUpdate
+
+
+class UpdateDeduplicator:
+    """Recognises updates that Telegram delivers more than once.
+
+    The last size update ids are kept in a ring buffer with a set for lookups.
+    With shared set, ids are also inserted into ProcessedUpdate, which catches
+    a redelivery that lands on another worker. An id is only recorded once
+    the update has been handled, and with transactional set once the
+    transaction around it has committed, so an update whose handler failed
+    runs again when it is retried or redelivered.
+    """
+
+    def __init__(self, size, shared, transactional=True):
+        self.shared = shared
+        self.transactional = transactional
+        self.rejected = 0
+        self.shared_rejected = 0
+        self._ring = deque(maxlen=size)
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def handling(self, update_id):
+        """Yields True if update_id has been handled before, otherwise False
+        for the with block to handle it."""
+        with self._lock:
+            duplicate = update_id in self._seen
+            self.rejected += duplicate
+        if duplicate:
+            yield True
+            return
+        # The ProcessedUpdate row commits or rolls back with the handler
+        with transaction.atomic() if self.shared else nullcontext():
+            if self.shared and not ProcessedUpdate.mark(update_id):
+                with self._lock:
+                    self.rejected += 1
+                    self.shared_rejected += 1
+                yield True
+                return
+            yield False
+            if self.transactional and transaction.get_connection().in_atomic_block:
+                transaction.on_commit(lambda: self._remember(update_id))
+            else:
+                self._remember(update_id)
+
+    def _remember(self, update_id):
+        with self._lock:
+            if update_id in self._seen:
+                return
+            if len(self._ring) == self._ring.maxlen:
+                self._seen.discard(self._ring[0])
+            self._ring.append(update_id)
+            self._seen.add(update_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._ring),
+                'rejected': self.rejected,
+                'shared_rejected': self.shared_rejected,
+            }
+
+
+deduplicator = UpdateDeduplicator(size=getattr(settings, 'DEDUP_CACHE_SIZE', 10000),
+                                  shared=getattr(settings, 'DEDUP_SHARED', True))
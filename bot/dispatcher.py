@@ -0,0 +1,198 @@
+import atexit
+import bisect
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+from bot.metrics import current_command, telegram_call_seconds
+
+logger = logging.getLogger(__name__)
+
+REPLY = 0
+REFRESH = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Job:
+    def __init__(self, priority, seq, chat_id, method, args):
+        self.key = (priority, seq)
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.command = current_command.get()
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class SendDispatcher:
+    """Sends Telegram API calls within the global and per-chat rate limits.
+
+    Calls are taken in priority order (REPLY before REFRESH), one chat at a
+    time so that messages to a chat keep their order. The sender threads are
+    long-lived, so each keeps its own keep-alive session to the API.
+    """
+
+    def __init__(self, get_bot, senders, global_rate, global_burst, chat_rate, chat_burst, max_chats=10000):
+        self.get_bot = get_bot
+        self.senders = senders
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.send_seconds = 0.0
+        self._buckets = OrderedDict()
+        self._jobs = []
+        self._in_flight = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+
+    def submit(self, method, *args, chat_id, priority=REPLY):
+        job = _Job(priority, next(self._seq), chat_id, method, args)
+        with self._cond:
+            self._start()
+            bisect.insort(self._jobs, job)
+            self._cond.notify()
+        return job.future
+
+    def stats(self):
+        with self._cond:
+            return {
+                'replies_queued': sum(1 for job in self._jobs if job.key[0] == REPLY),
+                'refreshes_queued': sum(1 for job in self._jobs if job.key[0] == REFRESH),
+                'in_flight': len(self._in_flight),
+                'sent': self.sent,
+                'failed': self.failed,
+                'rate_limited': self.rate_limited,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'send_seconds': self.send_seconds,
+            }
+
+    def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._jobs or self._in_flight) and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.senders, thread_name_prefix='telegram-sender')
+            threading.Thread(target=self._run, name='telegram-dispatcher', daemon=True).start()
+            atexit.register(self.stop)
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._buckets) > self.max_chats:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self.global_bucket.delay(now)
+                if wait == 0:
+                    skipped = set(self._in_flight)
+                    for i, job in enumerate(self._jobs):
+                        if job.chat_id in skipped:
+                            continue
+                        chat_wait = self._bucket(job.chat_id).delay(now)
+                        if chat_wait == 0:
+                            del self._jobs[i]
+                            self._in_flight.add(job.chat_id)
+                            self._bucket(job.chat_id).take()
+                            self.global_bucket.take()
+                            return job
+                        skipped.add(job.chat_id)
+                        wait = chat_wait if wait == 0 else min(wait, chat_wait)
+                self._cond.wait(wait or None)
+
+    def _run(self):
+        while True:
+            job = self._next()
+            self._executor.submit(self._send, job)
+
+    def _send(self, job):
+        started = time.monotonic()
+        retry_after = None
+        try:
+            result = getattr(self.get_bot(), job.method)(*job.args)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+            else:
+                self._finish(job, started, error=e)
+                return
+        except Exception as e:
+            self._finish(job, started, error=e)
+            return
+
+        if retry_after is None:
+            self._finish(job, started, result=result)
+            return
+
+        telegram_call_seconds.observe(time.monotonic() - started, job.method, job.command)
+        with self._cond:
+            self.rate_limited += 1
+            self._bucket(job.chat_id).blocked_until = time.monotonic() + retry_after
+            self._in_flight.discard(job.chat_id)
+            bisect.insort(self._jobs, job)
+            self._cond.notify_all()
+
+    def _finish(self, job, started, result=None, error=None):
+        now = time.monotonic()
+        telegram_call_seconds.observe(now - started, job.method, job.command)
+        with self._cond:
+            self._in_flight.discard(job.chat_id)
+            wait = started - job.queued_at
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.send_seconds += now - started
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._cond.notify_all()
+        if error is None:
+            job.future.set_result(result)
+        else:
+            logger.warning('Telegram call %s to chat %s failed: %s', job.method, job.chat_id, error)
+            job.future.set_exception(error)
+
@@ -0,0 +1,66 @@
+import hmac
+import os
+import telebot
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from bot import metrics as bot_metrics
+from bot.bot import dispatcher, get_bot, edit_coalescer, process_update
+from bot.cache import queue_cache
+from bot.db import db_stats
+from bot.dedup import deduplicator
+from bot.ingest import ingest_pool
+from bot.sharding import message_chat_id, shard_map
+from bot.users import user_directory
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+def has_secret(request):
+    if not settings.WEBHOOK_SECRET:
+        return True
+    received = request.META.get('HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN', '')
+    return hmac.compare_digest(received, settings.WEBHOOK_SECRET)
+
+
+@csrf_exempt
+def webhook(request, token):
+    if request.method == 'GET':
+        try:
+            get_bot().remove_webhook()
+            get_bot().set_webhook(f"{os.getenv('APP_URL')}/{token}", secret_token=settings.WEBHOOK_SECRET or None)
+            return HttpResponse('Webhook was successfully set.')
+        except Exception as e:
+            return HttpResponse(str(e))
+
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    if not has_secret(request):
+        return HttpResponseForbidden()
+
+    update = telebot.types.Update.de_json(loads(request.body))
+    url = shard_map.forward_url(message_chat_id(update))
+    if url is not None:
+        return HttpResponse(status=shard_map.forward(url, request.body))
+    if not settings.WEBHOOK_INGEST:
+        process_update(update)
+    elif not ingest_pool.submit(update):
+        return HttpResponse('Too many updates.', status=503)
+    return HttpResponse('!')
+
+
+def metrics(request):
+    gauges = {
+        'cache': queue_cache.stats(),
+        'ingest': ingest_pool.stats(),
+        'dispatcher': dispatcher.stats(),
+        'coalescer': edit_coalescer.stats(),
+        'db': db_stats(),
+        'users': user_directory.stats(),
+        'dedup': deduplicator.stats(),
+        'shards': shard_map.stats(),
+    }
+    return HttpResponse(bot_metrics.expose(gauges), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,117 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from bot.bot import process_update
+from bot.sharding import message_chat_id
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def update_chat_id(update):
+    chat_id = message_chat_id(update)
+    return chat_id if chat_id is not None else update.update_id
+
+
+class IngestPool:
+    """Processes webhook updates on background workers.
+
+    Every chat is pinned to one worker, so updates of a chat are handled in the
+    order they arrived while different chats run in parallel.
+    """
+
+    def __init__(self, process, workers, size):
+        self.process = process
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._queues = [queue.Queue(maxsize=max(size // workers, 1)) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def submit(self, update):
+        self._start()
+        worker = self._queues[hash(update_chat_id(update)) % len(self._queues)]
+        try:
+            worker.put_nowait((update, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def stop(self, timeout=None):
+        with self._lock:
+            if self._stopped or not self._threads:
+                return
+            self._stopped = True
+        for worker in self._queues:
+            worker.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': len(self._queues),
+                'depth': sum(worker.qsize() for worker in self._queues),
+                'max_worker_depth': max(worker.qsize() for worker in self._queues),
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed,
+                'busy_seconds': self.busy_seconds,
+            }
+
+    def _start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads or self._stopped:
+                return
+            for i, worker in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(worker,), name=f'ingest-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.stop, settings.INGEST_DRAIN_TIMEOUT)
+
+    def _run(self, worker):
+        while True:
+            item = worker.get()
+            if item is _STOP:
+                return
+            update, queued_at = item
+            close_old_connections()
+            started = time.monotonic()
+            try:
+                self.process(update)
+                failed = 0
+            except Exception:
+                logger.exception('Failed to process update %s', update.update_id)
+                failed = 1
+            finally:
+                close_old_connections()
+            with self._lock:
+                self.processed += 1
+                self.failed += failed
+                self.busy_seconds += time.monotonic() - started
+            if started - queued_at > settings.INGEST_SLOW_SECONDS:
+                logger.warning('Update %s waited %.1fs in the ingest queue', update.update_id,
+                               started - queued_at)
+
+
+ingest_pool = IngestPool(process_update,
+                         workers=settings.INGEST_WORKERS,
+                         size=settings.INGEST_QUEUE_SIZE)
@@ -0,0 +1,147 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+from telebot import apihelper
+
+from bot.models import TelegramUser
+from bot.sharding import shard_map
+
+# Load test chats live far away from real Telegram group ids. Users get ids
+# above Telegram's, which fit in 52 bits, and usernames starting with a
+# digit, which Telegram does not allow, so they never take a real account's
+# username in TelegramUser.
+CHAT_ID_BASE = -1009000000000
+USER_ID_BASE = 2 ** 52
+
+SCENARIOS = ('mixed', 'rush', 'add', 'spam')
+
+
+class UpdateStream:
+    """Deterministic stream of synthetic webhook updates."""
+
+    def __init__(self, chats, seed):
+        self.chats = [CHAT_ID_BASE - i for i in range(chats)]
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.users = 0
+        self.user_ids = {}
+
+    def chat_ids(self):
+        return list(self.chats)
+
+    def generate(self, scenario, count):
+        updates = [self.message(chat_id, self.admin(chat_id), '/help') for chat_id in self.chats]
+        generate = getattr(self, f'_{scenario}')
+        while len(updates) < count:
+            updates.extend(generate())
+        return updates[:count]
+
+    def usernames(self):
+        return [self.admin(chat_id) for chat_id in self.chats] + [f'0user{i}' for i in range(1, self.users + 1)]
+
+    def admin(self, chat_id):
+        return f'0admin{-chat_id}'
+
+    def user(self):
+        self.users += 1
+        return f'0user{self.users}'
+
+    def message(self, chat_id, username, text, mentions=()):
+        self.update_id += 1
+        entities = []
+        if text.startswith('/'):
+            entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+        for mention in mentions:
+            entities.append({'type': 'mention', 'offset': text.index(f'@{mention}'), 'length': len(mention) + 1})
+        return {
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Load test {-chat_id}'},
+                'from': {'id': self.user_ids.setdefault(username, USER_ID_BASE + len(self.user_ids) + 1),
+                         'is_bot': False, 'first_name': username, 'username': username},
+                'text': text,
+                'entities': entities,
+            },
+        }
+
+    def _rush(self):
+        chat_id = self.random.choice(self.chats)
+        return [self.message(chat_id, self.user(), '/enter') for _ in range(self.random.randint(20, 50))]
+
+    def _add(self):
+        chat_id = self.random.choice(self.chats)
+        mentions = [self.user() for _ in range(self.random.randint(10, 40))]
+        text = '/add ' + ' '.join(f'@{m}' for m in mentions)
+        return [self.message(chat_id, self.admin(chat_id), text, mentions)]
+
+    def _spam(self):
+        chat_id = self.random.choice(self.chats)
+        return [self.message(chat_id, self.user(), '/queue') for _ in range(self.random.randint(5, 20))]
+
+    def _mixed(self):
+        chat_id = self.random.choice(self.chats)
+        roll = self.random.random()
+        if roll < 0.3:
+            return self._rush()
+        if roll < 0.4:
+            return self._add()
+        if roll < 0.6:
+            return self._spam()
+        texts = ['/where', '/who', '/leave', '/admins', 'just chatting', 'see you at the lab']
+        return [self.message(chat_id, self.user(), self.random.choice(texts)) for _ in range(10)]
+
+
+class _FakeResponse:
+    status_code = 200
+
+    def __init__(self, result):
+        self.text = json.dumps({'ok': True, 'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeTelegram:
+    """Stands in for the Telegram Bot API and counts the calls made to it."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    def uninstall(self):
+        apihelper.CUSTOM_REQUEST_SENDER = None
+
+    def request(self, method, url, params=None, **kwargs):
+        name = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[name] += 1
+            self._message_id += 1
+            message_id = self._message_id
+        params = params or {}
+        chat = {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'}
+        return _FakeResponse({'message_id': message_id, 'date': int(time.time()), 'chat': chat,
+                              'text': params.get('text', '')})
+
+
+def delete_users(stream):
+    """Deletes the synthetic senders of stream, and the placeholders made for
+    users it mentioned before they spoke, from every shard."""
+    for alias in shard_map.ring.shards:
+        TelegramUser.objects.using(alias).filter(id__gte=USER_ID_BASE).delete()
+        TelegramUser.objects.using(alias).filter(id__lt=0, username__in=stream.usernames()).delete()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
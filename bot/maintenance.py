@@ -0,0 +1,135 @@
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from bot.models import Cooldown, ProcessedUpdate, Queue, QueueAdmin, QueueEntry, TelegramUser, UpdateOffset
+
+# Every job works in batches of short statements. Queue rows are selected with
+# FOR UPDATE SKIP LOCKED, so a queue that is busy right now is simply left for
+# the next run instead of blocking the bot.
+
+RESET_SQL = '''
+    WITH due AS (
+        SELECT chat_id FROM {queues}
+        WHERE reset_time IS NOT NULL
+          AND coalesce(last_reset, '-infinity') < date_trunc('day', now() - reset_time::interval) + reset_time::interval
+        ORDER BY chat_id LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    ), cleared AS (
+        DELETE FROM {entries} e USING due WHERE e.queue_id = due.chat_id
+    )
+    UPDATE {queues} q SET last_reset = now() FROM due WHERE q.chat_id = due.chat_id
+    RETURNING q.chat_id
+'''
+
+PURGE_SQL = '''
+    WITH stale AS (
+        SELECT chat_id FROM {queues} WHERE last_active < %(cutoff)s
+        ORDER BY last_active LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    ), entries AS (
+        DELETE FROM {entries} e USING stale WHERE e.queue_id = stale.chat_id
+    ), admins AS (
+        DELETE FROM {admins} a USING stale WHERE a.queue_id = stale.chat_id
+    ), cooldowns AS (
+        DELETE FROM {cooldowns} c USING stale WHERE c.chat_id = stale.chat_id
+    ), offsets AS (
+        DELETE FROM {offsets} o USING stale WHERE o.chat_id = stale.chat_id
+    )
+    DELETE FROM {queues} q USING stale WHERE q.chat_id = stale.chat_id
+    RETURNING q.chat_id
+'''
+
+EXPIRED_COOLDOWNS_SQL = '''
+    DELETE FROM {cooldowns} WHERE id IN (
+        SELECT id FROM {cooldowns} WHERE expires_at < now() LIMIT %(batch_size)s
+    )
+    RETURNING id
+'''
+
+# Telegram gives up redelivering an update after a day
+OLD_UPDATES_SQL = '''
+    DELETE FROM {updates} WHERE update_id IN (
+        SELECT update_id FROM {updates} WHERE received_at < now() - interval '1 day' LIMIT %(batch_size)s
+    )
+    RETURNING update_id
+'''
+
+ORPHAN_PLACEHOLDERS_SQL = '''
+    DELETE FROM {users} WHERE id IN (
+        SELECT u.id FROM {users} u
+        WHERE u.id < 0 AND NOT EXISTS (SELECT 1 FROM {entries} e WHERE e.user_id = u.id)
+        LIMIT %(batch_size)s
+    )
+    RETURNING id
+'''
+
+NEXT_QUEUES_SQL = '''
+    SELECT chat_id FROM {queues} WHERE chat_id > %(after)s ORDER BY chat_id LIMIT %(batch_size)s
+'''
+
+# Positions only ever grow (see QueueEntry.APPEND_SQL); this numbers them
+# from 1 again without changing the order.
+RENUMBER_SQL = '''
+    WITH numbered AS (
+        SELECT id, row_number() OVER (PARTITION BY queue_id ORDER BY position, id) AS position
+        FROM {entries} WHERE queue_id = ANY(%(chat_ids)s::bigint[])
+    )
+    UPDATE {entries} e SET position = numbered.position FROM numbered
+    WHERE e.id = numbered.id AND e.position <> numbered.position
+    RETURNING e.id
+'''
+
+
+def _run(sql, using, **params):
+    tables = {
+        'queues': Queue._meta.db_table,
+        'entries': QueueEntry._meta.db_table,
+        'admins': QueueAdmin._meta.db_table,
+        'cooldowns': Cooldown._meta.db_table,
+        'offsets': UpdateOffset._meta.db_table,
+        'users': TelegramUser._meta.db_table,
+        'updates': ProcessedUpdate._meta.db_table,
+    }
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql.format(**tables), params)
+        return cursor.fetchall()
+
+
+def _batches(sql, using, batch_size, **params):
+    while True:
+        done = len(_run(sql, using, batch_size=batch_size, **params))
+        if done:
+            yield done
+        if done < batch_size:
+            return
+
+
+def reset_due_queues(batch_size=500, using=DEFAULT_DB_ALIAS):
+    """Clears every queue whose daily reset time has passed since its last
+    reset. Yields the number of queues reset by each batch."""
+    yield from _batches(RESET_SQL, using, batch_size)
+
+
+def purge_stale_queues(cutoff, batch_size=500, using=DEFAULT_DB_ALIAS):
+    """Deletes queues inactive since cutoff together with their entries,
+    admins, cooldowns and polling offsets. Yields the number of queues
+    deleted by each batch."""
+    yield from _batches(PURGE_SQL, using, batch_size, cutoff=cutoff)
+
+
+def compact(batch_size=500, using=DEFAULT_DB_ALIAS):
+    """Drops expired cooldowns, old processed update ids and unused
+    placeholder users and renumbers queue positions. Yields (what, count) for
+    each batch."""
+    for done in _batches(EXPIRED_COOLDOWNS_SQL, using, batch_size):
+        yield 'cooldowns', done
+    for done in _batches(OLD_UPDATES_SQL, using, batch_size):
+        yield 'updates', done
+    for done in _batches(ORPHAN_PLACEHOLDERS_SQL, using, batch_size):
+        yield 'placeholders', done
+    after = -2 ** 63
+    while True:
+        chat_ids = [row[0] for row in _run(NEXT_QUEUES_SQL, using, after=after, batch_size=batch_size)]
+        if not chat_ids:
+            return
+        yield 'positions', len(_run(RENUMBER_SQL, using, chat_ids=chat_ids))
+        after = chat_ids[-1]
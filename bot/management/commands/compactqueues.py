@@ -0,0 +1,22 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from bot.maintenance import compact
+
+
+class Command(BaseCommand):
+    help = 'Drops expired cooldowns, old update ids and unused placeholder users, and renumbers queue positions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows or queues handled per statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database (shard) to work on.')
+
+    def handle(self, *args, **options):
+        totals = Counter()
+        for what, done in compact(options['batch_size'], options['database']):
+            totals[what] += done
+            self.stdout.write(f'{what}: {totals[what]} so far.')
+        self.stdout.write(f'Removed {totals["cooldowns"]} expired cooldowns, {totals["updates"]} update ids and '
+                          f'{totals["placeholders"]} placeholder users, renumbered {totals["positions"]} queue entries.')
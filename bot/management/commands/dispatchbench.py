@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+from telebot import TeleBot
+from telebot.types import Update
+
+from bot.bot import COMMANDS, parse_command
+from bot.loadtest import UpdateStream
+
+
+class Command(BaseCommand):
+    help = "Compares routing updates through the command table with TeleBot's handler scan."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--updates', type=int, default=20000)
+        parser.add_argument('--rounds', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        # Handlers are replaced with a counter so that only routing is measured.
+        stream = UpdateStream(50, options['seed'])
+        updates = [Update.de_json(update) for update in stream.generate('mixed', options['updates'])]
+        calls = []
+
+        def noop(msg):
+            calls.append(msg)
+
+        stock = TeleBot('0:bench', threaded=False)
+        names = {}
+        for name, handler in COMMANDS.items():
+            names.setdefault(handler, []).append(name)
+        for handler_names in names.values():
+            stock.register_message_handler(noop, commands=handler_names)
+        table = {name: noop for name in COMMANDS}
+
+        def stock_dispatch():
+            stock.process_new_updates(updates)
+
+        def table_dispatch():
+            for update in updates:
+                msg = update.message
+                if msg is not None and msg.content_type == 'text':
+                    handler = table.get(parse_command(msg.text))
+                    if handler is not None:
+                        handler(msg)
+
+        for label, dispatch in (('telebot', stock_dispatch), ('table', table_dispatch)):
+            best = float('inf')
+            for _ in range(options['rounds']):
+                calls.clear()
+                started = time.perf_counter()
+                dispatch()
+                best = min(best, time.perf_counter() - started)
+            self.stdout.write(f'{label:8} {best / len(updates) * 1e6:7.2f}us per update, '
+                              f'{len(calls)} of {len(updates)} routed to a handler')
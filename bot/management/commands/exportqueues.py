@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from bot.models import Queue
+from bot.snapshot import export_queues, open_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Streams every queue to a line-delimited JSON snapshot (gzipped if the path ends with .gz).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to write, or - for stdout.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per round trip.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database (shard) to work on.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stream = open_snapshot(options['path'], 'wb')
+        try:
+            written = export_queues(stream, options['chunk_size'], Queue.objects.using(options['database']))
+        finally:
+            if options['path'] != '-':
+                stream.close()
+        if options['path'] != '-':
+            self.stdout.write(f'Exported {written} queues in {time.perf_counter() - started:.1f}s.')
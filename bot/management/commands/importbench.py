@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+IMPORT_SCRIPT = '''
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+'''
+
+
+class Command(BaseCommand):
+    help = 'Reports the import cost of each module when a worker starts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default='botnet.settings', help='Settings module to start with.')
+        parser.add_argument('--top', type=int, default=25)
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=options['module'])
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT],
+                                env=env, capture_output=True, text=True)
+        modules = []
+        for line in output.stderr.splitlines():
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            modules.append((int(cumulative_us), int(self_us), name.strip()))
+        if output.returncode != 0 or not modules:
+            self.stderr.write(output.stderr)
+            return
+
+        packages = defaultdict(int)
+        for _, self_us, name in modules:
+            packages[name.split('.')[0]] += self_us
+        total = sum(packages.values())
+
+        self.stdout.write(f'Total import time: {total / 1000:.1f}ms\n')
+        self.stdout.write('By package (self time):')
+        for package, self_us in sorted(packages.items(), key=lambda p: -p[1])[:options['top']]:
+            self.stdout.write(f'  {self_us / 1000:8.1f}ms  {package}')
+        self.stdout.write('\nBy module (cumulative time):')
+        for cumulative_us, _, name in sorted(modules, reverse=True)[:options['top']]:
+            self.stdout.write(f'  {cumulative_us / 1000:8.1f}ms  {name}')
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from bot.snapshot import import_queues, open_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Restores queues from a snapshot written by exportqueues, replacing queues of the same chats.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to read, or - for stdin.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Queues written per transaction.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database (shard) to work on.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stream = open_snapshot(options['path'], 'rb')
+        try:
+            imported = import_queues(stream, options['batch_size'], options['database'])
+        finally:
+            if options['path'] != '-':
+                stream.close()
+        self.stdout.write(f'Imported {imported} queues in {time.perf_counter() - started:.1f}s.')
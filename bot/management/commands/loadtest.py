@@ -0,0 +1,97 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test import Client
+
+from bot.db import db_stats
+from bot.loadtest import SCENARIOS, FakeTelegram, UpdateStream, delete_users, percentile
+from bot.metrics import execute_wrapper
+from bot.models import ProcessedUpdate, Queue
+from bot.sharding import shard_map
+
+
+class Command(BaseCommand):
+    help = 'Replays a synthetic stream of Telegram updates against the webhook and reports its performance.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+        parser.add_argument('--updates', type=int, default=2000)
+        parser.add_argument('--chats', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--path', default='/loadtest', help='Webhook URL to post the updates to.')
+        parser.add_argument('--respect-limits', action='store_true',
+                            help='Keep the Telegram rate limits of the send dispatcher.')
+        parser.add_argument('--output', help='Also write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        from bot.bot import dispatcher, edit_coalescer
+        from bot.dispatcher import TokenBucket
+
+        stream = UpdateStream(options['chats'], options['seed'])
+        updates = [json.dumps(u) for u in stream.generate(options['scenario'], options['updates'])]
+        self.clean_up(stream)
+
+        if not options['respect_limits']:
+            dispatcher.global_bucket = TokenBucket(10 ** 9, 10 ** 9)
+            dispatcher.chat_rate = dispatcher.chat_burst = 10 ** 9
+
+        telegram = FakeTelegram()
+        telegram.install()
+        queries = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        client = Client()
+        latencies = []
+        try:
+            with execute_wrapper(count_queries):
+                started = time.perf_counter()
+                opened = db_stats()['connections_opened']
+                for body in updates:
+                    sent = time.perf_counter()
+                    # The test client skips Django's per-request connection
+                    # handling, so do it here the way a real worker would.
+                    close_old_connections()
+                    client.post(options['path'], data=body, content_type='application/json',
+                                HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=settings.WEBHOOK_SECRET)
+                    close_old_connections()
+                    latencies.append(time.perf_counter() - sent)
+                opened = db_stats()['connections_opened'] - opened
+                elapsed = time.perf_counter() - started
+            edit_coalescer.flush()
+            dispatcher.stop()
+        finally:
+            telegram.uninstall()
+            self.clean_up(stream)
+
+        results = {
+            'scenario': options['scenario'],
+            'updates': len(updates),
+            'chats': options['chats'],
+            'seed': options['seed'],
+            'seconds': elapsed,
+            'updates_per_second': len(updates) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_update': queries[0] / len(updates),
+            'connections_opened': opened,
+            'api_calls_per_update': sum(telegram.calls.values()) / len(updates),
+            'api_calls': dict(telegram.calls),
+        }
+        for key, value in results.items():
+            self.stdout.write(f'{key}: {value:.3f}' if isinstance(value, float) else f'{key}: {value}')
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def clean_up(self, stream):
+        # Synthetic update ids start at 1, far below real ones; forget earlier runs.
+        ProcessedUpdate.objects.filter(update_id__lte=stream.update_id).delete()
+        for alias in shard_map.ring.shards:
+            Queue.objects.using(alias).filter(chat_id__in=stream.chat_ids()).delete()
+        delete_users(stream)
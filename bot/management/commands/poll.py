@@ -0,0 +1,93 @@
+import logging
+import time
+from collections import OrderedDict
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from telebot.apihelper import ApiException
+
+from bot.bot import collected, edit_coalescer, get_bot, process_update, send_collected
+from bot.cache import queue_cache
+from bot.models import UpdateOffset
+from bot.sharding import message_chat_id, shard_map
+
+logger = logging.getLogger(__name__)
+
+GLOBAL = 0
+MAX_BACKOFF = 60
+
+
+class Command(BaseCommand):
+    help = 'Runs the bot in long-polling mode instead of behind the webhook.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='Updates to fetch per request.')
+        parser.add_argument('--timeout', type=int, default=30, help='Long polling timeout in seconds.')
+
+    def handle(self, *args, **options):
+        bot = get_bot()
+        bot.remove_webhook()
+        offset = UpdateOffset.objects.filter(chat_id=GLOBAL).values_list('update_id', flat=True).first()
+        offset = offset + 1 if offset is not None else None
+        self.stdout.write('Polling for updates.')
+        backoff = 1
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, limit=options['limit'], timeout=options['timeout'])
+            except (requests.RequestException, ApiException):
+                logger.exception('Fetching updates failed, retrying in %s s.', backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = 1
+            if not updates:
+                continue
+            self.process(updates)
+            offset = updates[-1].update_id + 1
+            UpdateOffset.objects.update_or_create(chat_id=GLOBAL, defaults={'update_id': offset - 1})
+
+    def process(self, updates):
+        # Updates without a chat are grouped under None and get no watermark
+        chats = OrderedDict()
+        for update in updates:
+            chats.setdefault(message_chat_id(update), []).append(update)
+
+        watermarks = dict(UpdateOffset.objects.filter(chat_id__in=[chat_id for chat_id in chats if chat_id is not None])
+                          .values_list('chat_id', 'update_id'))
+        for chat_id, chat_updates in chats.items():
+            done = watermarks.get(chat_id, -1)
+            chat_updates = [u for u in chat_updates if u.update_id > done]
+            if not chat_updates:
+                continue
+            try:
+                self.process_chat(chat_id, chat_updates)
+            except Exception:
+                logger.exception('Batch for chat %s failed, handling its updates one by one.', chat_id)
+                for update in chat_updates:
+                    try:
+                        self.process_chat(chat_id, [update])
+                    except Exception:
+                        logger.exception('Update %s failed.', update.update_id)
+        edit_coalescer.flush()
+
+    def process_chat(self, chat_id, updates):
+        try:
+            # Offsets live in the default database, the queue in the chat's shard.
+            # Replies go out only once the batch has committed, so a batch
+            # that is replayed update by update does not answer twice.
+            with transaction.atomic(), transaction.atomic(using=shard_map.owner(chat_id)), collected() as outbox:
+                for update in updates:
+                    process_update(update)
+                if chat_id is not None:
+                    UpdateOffset.objects.update_or_create(chat_id=chat_id,
+                                                          defaults={'update_id': updates[-1].update_id})
+                transaction.on_commit(lambda: self.send(chat_id, outbox))
+        except Exception:
+            if chat_id is not None:
+                queue_cache.invalidate(chat_id)
+            raise
+
+    def send(self, chat_id, outbox):
+        with shard_map.using(chat_id):
+            send_collected(outbox)
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from bot.maintenance import purge_stale_queues
+from bot.models import Queue
+from bot.snapshot import export_queues, open_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Deletes queues that have not been used for a number of days.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Days without activity.')
+        parser.add_argument('--archive', help='Export the queues to this snapshot file before deleting them.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Queues deleted per statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database (shard) to work on.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        if options['archive']:
+            with open_snapshot(options['archive'], 'wb') as stream:
+                archived = export_queues(stream, queues=Queue.objects.using(options['database']).filter(last_active__lt=cutoff))
+            self.stdout.write(f'Archived {archived} queues to {options["archive"]}.')
+
+        total = 0
+        for done in purge_stale_queues(cutoff, options['batch_size'], options['database']):
+            total += done
+            self.stdout.write(f'Deleted {total} queues so far.')
+        self.stdout.write(f'Deleted {total} queues inactive since {cutoff:%Y-%m-%d}.')
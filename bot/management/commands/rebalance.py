@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.rebalance import rebalance
+from bot.sharding import shard_map
+
+
+class Command(BaseCommand):
+    help = 'Moves queues to the shard that owns them after SHARDS changed. Safe to run while the bot is serving.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Queues checked per batch.')
+
+    def handle(self, *args, **options):
+        if shard_map.previous is None:
+            raise CommandError('Set SHARDS_PREVIOUS to the shard list from before the change.')
+        totals = {}
+        for source, moved in rebalance(shard_map, options['batch_size']):
+            if totals.get(source) != moved:
+                self.stdout.write(f'{source}: moved {moved} queues so far.')
+            totals[source] = moved
+        self.stdout.write(f'Moved {sum(totals.values())} queues. SHARDS_PREVIOUS can be removed now.')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from bot.maintenance import reset_due_queues
+
+
+class Command(BaseCommand):
+    help = 'Clears queues whose daily /schedule reset time has passed. Run it every few minutes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Queues reset per statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database (shard) to work on.')
+
+    def handle(self, *args, **options):
+        total = 0
+        for done in reset_due_queues(options['batch_size'], options['database']):
+            total += done
+            self.stdout.write(f'Reset {total} queues so far.')
+        self.stdout.write(f'Reset {total} queues.')
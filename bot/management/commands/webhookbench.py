@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from bot.loadtest import FakeTelegram, UpdateStream, delete_users, percentile
+
+IMPORT_SCRIPT = '''
+import time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import resolve
+resolve('/token')
+print(time.perf_counter() - started)
+'''
+
+PROFILES = {
+    'drf': 'botnet.settings',
+    'lean': 'botnet.settings_webhook',
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares the DRF webhook view with the lean webhook endpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        # Plain chat messages reach the webhook but no handler, so the numbers
+        # show the cost of the request path itself.
+        stream = UpdateStream(1, options['seed'])
+        chat_id = stream.chat_ids()[0]
+        bodies = [json.dumps(stream.message(chat_id, stream.user(), 'see you at the lab'))
+                  for _ in range(options['requests'])]
+
+        telegram = FakeTelegram()
+        telegram.install()
+        try:
+            self.report('drf', self.run(Client(), bodies))
+            with override_settings(MIDDLEWARE=[], ROOT_URLCONF='botnet.urls_webhook'):
+                self.report('lean', self.run(Client(), bodies))
+        finally:
+            telegram.uninstall()
+            delete_users(stream)
+
+        for name, module in PROFILES.items():
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE=module)
+            output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], env=env, capture_output=True, text=True)
+            if output.returncode == 0:
+                self.stdout.write(f'{name}: startup {float(output.stdout) * 1000:.1f}ms')
+            else:
+                self.stderr.write(f'{name}: startup failed\n{output.stderr}')
+
+    def run(self, client, bodies):
+        latencies = []
+        for body in bodies:
+            started = time.perf_counter()
+            client.post('/token', data=body, content_type='application/json',
+                        HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=settings.WEBHOOK_SECRET)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    def report(self, name, latencies):
+        self.stdout.write(f'{name}: {len(latencies) / sum(latencies):.0f} req/s, '
+                          f'p50 {percentile(latencies, 50) * 1000:.3f}ms, '
+                          f'p99 {percentile(latencies, 99) * 1000:.3f}ms')
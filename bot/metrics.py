@@ -0,0 +1,122 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Command of the update being handled, picked up by work done on its behalf
+current_command = ContextVar('current_command', default='none')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(pairs, le=None):
+    if le is not None:
+        pairs = pairs + [f'le="{le}"']
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                pairs = [f'{k}="{v}"' for k, v in zip(self.labels, labels)]
+                cumulative = 0
+                for le, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(f'{self.name}_bucket{_labels(pairs, le)} {cumulative}')
+                lines.append(f'{self.name}_bucket{_labels(pairs, "+Inf")} {count}')
+                lines.append(f'{self.name}_sum{_labels(pairs)} {total}')
+                lines.append(f'{self.name}_count{_labels(pairs)} {count}')
+        return lines
+
+
+update_seconds = Histogram('bot_update_seconds', 'End to end time to handle an update.', ('command',))
+update_queries = Histogram('bot_update_queries', 'SQL queries run for an update.', ('command',), COUNT_BUCKETS)
+update_query_seconds = Histogram('bot_update_query_seconds', 'Time spent in SQL for an update.', ('command',))
+telegram_call_seconds = Histogram('bot_telegram_call_seconds', 'Duration of outgoing Telegram API calls.',
+                                  ('method', 'command'))
+
+HISTOGRAMS = [update_seconds, update_queries, update_query_seconds, telegram_call_seconds]
+
+
+def execute_wrapper(wrapper):
+    # connection.execute_wrapper() for every database: replicas serve the
+    # reads of read-only commands and shards hold the queues.
+    stack = ExitStack()
+    for alias in settings.DATABASES:
+        stack.enter_context(connections[alias].execute_wrapper(wrapper))
+    return stack
+
+
+class profile_update:
+    """Records the latency and SQL queries of the update handled inside it."""
+
+    def __init__(self, command):
+        self.command = command
+        self.queries = []
+
+    def _record(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+    def __enter__(self):
+        self._token = current_command.set(self.command)
+        self._wrapper = execute_wrapper(self._record)
+        self._wrapper.__enter__()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self._started
+        self._wrapper.__exit__(*exc_info)
+        current_command.reset(self._token)
+        query_seconds = sum(duration for _, duration in self.queries)
+        update_seconds.observe(elapsed, self.command)
+        update_queries.observe(len(self.queries), self.command)
+        update_query_seconds.observe(query_seconds, self.command)
+        if settings.SLOW_UPDATE_SECONDS and elapsed >= settings.SLOW_UPDATE_SECONDS:
+            logger.warning('Slow update /%s took %.3fs, %d queries in %.3fs:\n%s', self.command, elapsed,
+                           len(self.queries), query_seconds,
+                           '\n'.join(f'{duration:.4f}s {sql}' for sql, duration in self.queries))
+
+
+def expose(gauges):
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.expose())
+    for component, stats in gauges.items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                lines.append(f'bot_{component}_{key} {value}')
+    return '\n'.join(lines) + '\n'
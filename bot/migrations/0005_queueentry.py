@@ -0,0 +1,57 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_users_to_entries(apps, schema_editor):
+    Queue = apps.get_model('bot', 'Queue')
+    QueueEntry = apps.get_model('bot', 'QueueEntry')
+    db = schema_editor.connection.alias
+    entries = []
+    for chat_id, users in Queue.objects.using(db).values_list('chat_id', 'users').iterator():
+        seen = set()
+        for position, username in enumerate(users or [], start=1):
+            if username in seen:
+                continue
+            seen.add(username)
+            entries.append(QueueEntry(queue_id=chat_id, username=username, position=position))
+    QueueEntry.objects.using(db).bulk_create(entries, batch_size=1000)
+
+
+def copy_entries_to_users(apps, schema_editor):
+    Queue = apps.get_model('bot', 'Queue')
+    db = schema_editor.connection.alias
+    for q in Queue.objects.using(db).iterator():
+        q.users = list(q.entries.using(db).order_by('position', 'id').values_list('username', flat=True))
+        q.save(using=db, update_fields=['users'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_auto_20210218_1226'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=33, null=True)),
+                ('position', models.BigIntegerField()),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='bot.queue')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['queue', 'position'], name='bot_queueentry_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='queueentry',
+            constraint=models.UniqueConstraint(fields=('queue', 'username'), name='bot_queueentry_unique_username'),
+        ),
+        migrations.RunPython(copy_users_to_entries, copy_entries_to_users),
+        migrations.RemoveField(
+            model_name='queue',
+            name='users',
+        ),
+    ]
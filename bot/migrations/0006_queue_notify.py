@@ -0,0 +1,40 @@
+from django.db import migrations
+
+CREATE_SQL = '''
+CREATE OR REPLACE FUNCTION bot_queue_notify() RETURNS trigger AS $$
+DECLARE
+    chat bigint;
+BEGIN
+    IF TG_TABLE_NAME = 'bot_queueentry' THEN
+        IF TG_OP = 'DELETE' THEN chat := OLD.queue_id; ELSE chat := NEW.queue_id; END IF;
+    ELSE
+        IF TG_OP = 'DELETE' THEN chat := OLD.chat_id; ELSE chat := NEW.chat_id; END IF;
+    END IF;
+    PERFORM pg_notify('bot_queue', chat || ' ' || pg_backend_pid());
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bot_queue_notify AFTER UPDATE OR DELETE ON bot_queue
+    FOR EACH ROW EXECUTE PROCEDURE bot_queue_notify();
+
+CREATE TRIGGER bot_queueentry_notify AFTER INSERT OR UPDATE OR DELETE ON bot_queueentry
+    FOR EACH ROW EXECUTE PROCEDURE bot_queue_notify();
+'''
+
+DROP_SQL = '''
+DROP TRIGGER IF EXISTS bot_queueentry_notify ON bot_queueentry;
+DROP TRIGGER IF EXISTS bot_queue_notify ON bot_queue;
+DROP FUNCTION IF EXISTS bot_queue_notify();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_queueentry'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, DROP_SQL),
+    ]
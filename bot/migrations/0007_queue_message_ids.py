@@ -0,0 +1,30 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+def copy_message_id(apps, schema_editor):
+    schema_editor.execute('UPDATE bot_queue SET message_ids = ARRAY[message_id] WHERE message_id <> 0')
+
+
+def restore_message_id(apps, schema_editor):
+    schema_editor.execute('UPDATE bot_queue SET message_id = message_ids[1] WHERE cardinality(message_ids) > 0')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_queue_notify'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='message_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.RunPython(copy_message_id, restore_message_id),
+        migrations.RemoveField(
+            model_name='queue',
+            name='message_id',
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_queue_message_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cooldown',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField()),
+                ('command', models.CharField(max_length=16)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cooldown',
+            constraint=models.UniqueConstraint(fields=('chat_id', 'command'), name='bot_cooldown_unique_command'),
+        ),
+        migrations.RemoveField(
+            model_name='queue',
+            name='admins_timestamp',
+        ),
+        migrations.RemoveField(
+            model_name='queue',
+            name='list_timestamp',
+        ),
+        migrations.RemoveField(
+            model_name='queue',
+            name='who_timestamp',
+        ),
+    ]
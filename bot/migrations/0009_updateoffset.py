@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_cooldown'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpdateOffset',
+            fields=[
+                ('chat_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('update_id', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,72 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+NOTIFY_SQL = '''
+CREATE OR REPLACE FUNCTION bot_queue_notify() RETURNS trigger AS $$
+DECLARE
+    chat bigint;
+BEGIN
+    IF TG_TABLE_NAME IN ('bot_queueentry', 'bot_queueadmin') THEN
+        IF TG_OP = 'DELETE' THEN chat := OLD.queue_id; ELSE chat := NEW.queue_id; END IF;
+    ELSE
+        IF TG_OP = 'DELETE' THEN chat := OLD.chat_id; ELSE chat := NEW.chat_id; END IF;
+    END IF;
+    PERFORM pg_notify('bot_queue', chat || ' ' || pg_backend_pid());
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bot_queueadmin_notify AFTER INSERT OR UPDATE OR DELETE ON bot_queueadmin
+    FOR EACH ROW EXECUTE PROCEDURE bot_queue_notify();
+'''
+
+DROP_NOTIFY_SQL = '''
+DROP TRIGGER IF EXISTS bot_queueadmin_notify ON bot_queueadmin;
+'''
+
+
+def copy_admins(apps, schema_editor):
+    Queue = apps.get_model('bot', 'Queue')
+    QueueAdmin = apps.get_model('bot', 'QueueAdmin')
+    db = schema_editor.connection.alias
+    admins = []
+    for chat_id, usernames in Queue.objects.using(db).values_list('chat_id', 'admins').iterator():
+        for username in dict.fromkeys(usernames or []):
+            admins.append(QueueAdmin(queue_id=chat_id, username=username or ''))
+    QueueAdmin.objects.using(db).bulk_create(admins, batch_size=1000, ignore_conflicts=True)
+
+
+def restore_admins(apps, schema_editor):
+    Queue = apps.get_model('bot', 'Queue')
+    db = schema_editor.connection.alias
+    for q in Queue.objects.using(db).iterator():
+        q.admins = list(q.admin_entries.using(db).order_by('id').values_list('username', flat=True))
+        q.save(using=db, update_fields=['admins'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0009_updateoffset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueAdmin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=33)),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='admin_entries', to='bot.queue')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='queueadmin',
+            constraint=models.UniqueConstraint(fields=('queue', 'username'), name='bot_queueadmin_unique_username'),
+        ),
+        migrations.RunPython(copy_admins, restore_admins),
+        migrations.RemoveField(
+            model_name='queue',
+            name='admins',
+        ),
+        migrations.RunSQL(NOTIFY_SQL, DROP_NOTIFY_SQL),
+    ]
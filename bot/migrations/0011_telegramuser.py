@@ -0,0 +1,75 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.text
+
+# Existing entries only have usernames, so each distinct username gets a
+# placeholder user; it is merged into the real account the first time the
+# bot sees it. Entries without a username cannot be identified and are dropped.
+COPY_SQL = '''
+INSERT INTO bot_telegramuser (id, username, first_name)
+SELECT -nextval('bot_telegramuser_placeholder'), min(username), ''
+FROM bot_queueentry WHERE username <> '' GROUP BY upper(username);
+
+DELETE FROM bot_queueentry WHERE username IS NULL OR username = '';
+
+UPDATE bot_queueentry e SET user_id = u.id FROM bot_telegramuser u WHERE upper(u.username) = upper(e.username);
+
+DELETE FROM bot_queueentry e USING bot_queueentry o
+WHERE o.queue_id = e.queue_id AND o.user_id = e.user_id AND (o.position, o.id) < (e.position, e.id);
+
+SET CONSTRAINTS ALL IMMEDIATE;
+'''
+
+RESTORE_SQL = '''
+UPDATE bot_queueentry e SET username = u.username FROM bot_telegramuser u WHERE u.id = e.user_id;
+SET CONSTRAINTS ALL IMMEDIATE;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0010_queueadmin'),
+    ]
+
+    operations = [
+        migrations.RunSQL('CREATE SEQUENCE bot_telegramuser_placeholder',
+                          'DROP SEQUENCE bot_telegramuser_placeholder'),
+        migrations.CreateModel(
+            name='TelegramUser',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('username', models.CharField(max_length=33, null=True)),
+                ('first_name', models.CharField(blank=True, max_length=64)),
+            ],
+            options={
+                'indexes': [models.Index(django.db.models.functions.text.Upper('username'),
+                                         name='bot_telegramuser_username')],
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name='queueentry',
+            name='bot_queueentry_unique_username',
+        ),
+        migrations.AddField(
+            model_name='queueentry',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+',
+                                    to='bot.telegramuser'),
+        ),
+        migrations.RunSQL(COPY_SQL, RESTORE_SQL),
+        migrations.RemoveField(
+            model_name='queueentry',
+            name='username',
+        ),
+        migrations.AlterField(
+            model_name='queueentry',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+',
+                                    to='bot.telegramuser'),
+        ),
+        migrations.AddConstraint(
+            model_name='queueentry',
+            constraint=models.UniqueConstraint(fields=('queue', 'user'), name='bot_queueentry_unique_user'),
+        ),
+    ]
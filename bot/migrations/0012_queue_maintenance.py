@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0011_telegramuser'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='last_active',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='reset_time',
+            field=models.TimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='last_reset',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
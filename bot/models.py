@@ -1,61 +1,412 @@
+from datetime import timedelta
+
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Upper
 from django.utils import timezone
 
+from bot.cache import queue_cache
+from bot.routers import recent_writes
+
+
+def _fetchall(model, sql, using=None, **params):
+    with connections[using or router.db_for_write(model)].cursor() as cursor:
+        cursor.execute(sql.format(table=model._meta.db_table, users=TelegramUser._meta.db_table), params)
+        return cursor.fetchall()
+
 
 class Queue(models.Model):
     chat_id = models.BigIntegerField(primary_key=True)
     name = models.CharField(max_length=100)
-    users = ArrayField(models.CharField(max_length=33), blank=True, null=True)
-    admins = ArrayField(models.CharField(max_length=33))
     is_active = models.BooleanField(default=True)
     cooldown = models.IntegerField(default=10)
-    admins_timestamp = models.DateTimeField(default=timezone.now())
-    list_timestamp = models.DateTimeField(default=timezone.now())
-    who_timestamp = models.DateTimeField(default=timezone.now())
-    message_id = models.IntegerField(default=0)
+    message_ids = ArrayField(models.IntegerField(), default=list, blank=True)
+    last_active = models.DateTimeField(default=timezone.now, db_index=True)
+    # Daily reset time in UTC, see bot/maintenance.py
+    reset_time = models.TimeField(null=True, blank=True)
+    last_reset = models.DateTimeField(null=True, blank=True)
+
+    _users = None
+    _admins = None
+
+    def _written(self):
+        recent_writes.mark(self.chat_id)
+        queue_cache.store(self)
+
+    @staticmethod
+    def _results(values, changed):
+        results = []
+        for value in values:
+            results.append(value in changed)
+            changed.discard(value)
+        return results
+
+    def _update(self, **fields):
+        for field, value in fields.items():
+            setattr(self, field, value)
+        updated = Queue.objects.filter(chat_id=self.chat_id).update(**fields) > 0
+        self._written()
+        return updated
+
+    @property
+    def admins(self):
+        if self._admins is None:
+            self._admins = list(self.admin_entries.order_by('id').values_list('username', flat=True))
+            self._admin_set = frozenset(self._admins)
+        return self._admins
 
     def is_admin(self, username):
-        return self.admins.__contains__(username)
-
-    def add_user(self, username):
-        try:
-            self.users.index(username)
-            return False
-        except ValueError:
-            self.users.append(username)
-            self.save()
-            return True
-
-    def remove_user(self, username):
-        try:
-            self.users.remove(username)
-            self.save()
-            return True
-        except ValueError:
-            return False
+        # Admin lists are short, so load the whole set once; the instance is
+        # kept in queue_cache and later checks are answered from memory.
+        self.admins
+        return username in self._admin_set
+
+    def _members(self):
+        # (user id, display name) of everyone in the queue, in order
+        if self._users is None:
+            rows = self.entries.order_by('position', 'id').values_list('user_id', 'user__username', 'user__first_name')
+            self._users = [(user_id, TelegramUser.label(username, first_name))
+                           for user_id, username, first_name in rows]
+        return self._users
+
+    @property
+    def users(self):
+        return [label for _, label in self._members()]
+
+    def user_count(self):
+        if self._users is not None:
+            return len(self._users)
+        return self.entries.count()
+
+    def first_user(self):
+        if self._users is not None:
+            return self._users[0][1] if self._users else None
+        entry = self.entries.order_by('position', 'id').values_list('user__username', 'user__first_name').first()
+        return TelegramUser.label(*entry) if entry else None
+
+    def position_of(self, user_id):
+        if self._users is not None:
+            for i, (member, _) in enumerate(self._users):
+                if member == user_id:
+                    return i + 1
+            return None
+        return QueueEntry.position_of(self.chat_id, user_id)
+
+    def add_user(self, user_id):
+        return self.add_users([user_id])[0]
+
+    def remove_user(self, user_id):
+        return self.remove_users([user_id])[0]
+
+    def add_users(self, user_ids):
+        added = QueueEntry.append(self.chat_id, list(dict.fromkeys(user_ids)))
+        if self._users is not None:
+            self._users = self._users + list(added.items())
+        self._written()
+        return self._results(user_ids, set(added))
+
+    def remove_users(self, user_ids):
+        removed = QueueEntry.remove(self.chat_id, list(dict.fromkeys(user_ids)))
+        if self._users is not None:
+            self._users = [member for member in self._users if member[0] not in removed]
+        self._written()
+        return self._results(user_ids, removed)
+
+    def pop_user(self):
+        popped = QueueEntry.pop(self.chat_id)
+        if popped is not None and self._users and self._users[0][0] == popped[0]:
+            self._users = self._users[1:]
+        else:
+            self._users = None
+        self._written()
+        return popped[1] if popped is not None else None
+
+    def _set_admins(self, admins):
+        self._admins = admins
+        self._admin_set = frozenset(admins)
 
     def add_admin(self, username):
-        try:
-            self.admins.index(username)
-            return False
-        except ValueError:
-            self.admins.append(username)
-            self.save()
-            return True
+        return self.add_admins([username])[0]
 
     def remove_admin(self, username):
-        try:
-            self.admins.remove(username)
-            self.save()
-            return True
-        except ValueError:
-            return False
-
-    def update_message_id(self, message_id):
-        try:
-            self.message_id = message_id
-            self.save()
-            return True
-        except ValueError:
-            return False
+        return self.remove_admins([username])[0]
+
+    def add_admins(self, usernames):
+        unique = list(dict.fromkeys(usernames))
+        added = QueueAdmin.add(self.chat_id, unique)
+        if self._admins is not None:
+            self._set_admins(self._admins + [u for u in unique if u in added])
+        self._written()
+        return self._results(usernames, added)
+
+    def remove_admins(self, usernames):
+        removed = QueueAdmin.remove(self.chat_id, list(dict.fromkeys(usernames)))
+        if self._admins is not None:
+            self._set_admins([u for u in self._admins if u not in removed])
+        self._written()
+        return self._results(usernames, removed)
+
+    def set_active(self, is_active):
+        updated = Queue.objects.filter(chat_id=self.chat_id, is_active=not is_active).update(is_active=is_active)
+        self.is_active = is_active
+        self._written()
+        return updated > 0
+
+    def clear(self):
+        self._users = []
+        cleared = self.entries.all().delete()[0] > 0
+        self._written()
+        return cleared
+
+    def set_cooldown(self, cooldown):
+        return self._update(cooldown=cooldown)
+
+    def update_message_ids(self, message_ids):
+        return self._update(message_ids=message_ids)
+
+    def set_reset_time(self, reset_time):
+        # Counted from now, so a new schedule does not clear the queue at once
+        return self._update(reset_time=reset_time, last_reset=timezone.now())
+
+    def touch(self):
+        # Activity is only recorded once an hour, which is all the stale
+        # queue purge needs, so most commands do not write the queue row.
+        now = timezone.now()
+        if now - self.last_active >= timedelta(hours=1):
+            self._update(last_active=now)
+
+
+class Cooldown(models.Model):
+    chat_id = models.BigIntegerField()
+    command = models.CharField(max_length=16)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat_id', 'command'], name='bot_cooldown_unique_command'),
+        ]
+
+
+class UpdateOffset(models.Model):
+    # Last update handled in long-polling mode, per chat. The row for chat 0
+    # holds the offset confirmed to Telegram.
+    chat_id = models.BigIntegerField(primary_key=True)
+    update_id = models.BigIntegerField()
+
+
+class ProcessedUpdate(models.Model):
+    # Commands handled recently by any worker, so that updates redelivered by
+    # Telegram run only once. Pruned by compactqueues.
+    update_id = models.BigIntegerField(primary_key=True)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    MARK_SQL = '''
+        INSERT INTO {table} (update_id, received_at) VALUES (%(update_id)s, now())
+        ON CONFLICT (update_id) DO NOTHING
+        RETURNING update_id
+    '''
+
+    @classmethod
+    def mark(cls, update_id):
+        # False if the update has been marked before
+        return bool(_fetchall(cls, cls.MARK_SQL, update_id=update_id))
+
+
+class TelegramUser(models.Model):
+    # Filled from every update the bot sees. Ids below zero are placeholders
+    # for usernames mentioned before their owner wrote anything; they are
+    # merged into the real account once it shows up.
+    id = models.BigIntegerField(primary_key=True)
+    username = models.CharField(max_length=33, null=True)
+    first_name = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(Upper('username'), name='bot_telegramuser_username'),
+        ]
+
+    # A username belongs to one account at a time, so whoever held it before
+    # loses it. Unchanged rows are not rewritten.
+    RECORD_SQL = '''
+        WITH released AS (
+            UPDATE {table} SET username = NULL
+            WHERE upper(username) = upper(%(username)s) AND id > 0 AND id <> %(id)s
+        )
+        INSERT INTO {table} (id, username, first_name) VALUES (%(id)s, %(username)s, %(first_name)s)
+        ON CONFLICT (id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name
+        WHERE ({table}.username, {table}.first_name) IS DISTINCT FROM (excluded.username, excluded.first_name)
+        RETURNING id
+    '''
+
+    # Real accounts win over placeholders left for the same username.
+    RESOLVE_SQL = '''
+        SELECT DISTINCT ON (upper(username)) upper(username), id FROM {table}
+        WHERE upper(username) = ANY(%(keys)s::varchar(33)[])
+        ORDER BY upper(username), id DESC
+    '''
+
+    PLACEHOLDER_SQL = '''
+        INSERT INTO {table} (id, username, first_name)
+        SELECT -nextval('bot_telegramuser_placeholder'), new.username, ''
+        FROM unnest(%(usernames)s::varchar(33)[]) AS new(username)
+        RETURNING upper(username), id
+    '''
+
+    @staticmethod
+    def label(username, first_name):
+        return f'@{username}' if username else first_name
+
+    @classmethod
+    def record(cls, user_id, username, first_name):
+        return bool(_fetchall(cls, cls.RECORD_SQL, id=user_id, username=username, first_name=first_name))
+
+    @classmethod
+    def resolve(cls, usernames, using=None):
+        # Maps upper-cased usernames to ids, creating placeholders for the
+        # ones nobody has been seen with.
+        if not usernames:
+            return {}
+        spelling = {username.upper(): username for username in usernames}
+        ids = dict(_fetchall(cls, cls.RESOLVE_SQL, using=using, keys=list(spelling)))
+        missing = [username for key, username in spelling.items() if key not in ids]
+        if missing:
+            ids.update(_fetchall(cls, cls.PLACEHOLDER_SQL, using=using, usernames=missing))
+        return ids
+
+
+class QueueEntry(models.Model):
+    queue = models.ForeignKey(Queue, on_delete=models.CASCADE, related_name='entries')
+    user = models.ForeignKey(TelegramUser, on_delete=models.CASCADE, related_name='+')
+    position = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'user'], name='bot_queueentry_unique_user'),
+        ]
+        indexes = [
+            models.Index(fields=['queue', 'position'], name='bot_queueentry_position'),
+        ]
+
+    # New entries take the next position after the current tail, which is read
+    # from the (queue, position) index. Positions are never renumbered, so
+    # removals and pops do not touch the rest of the queue. Ids of users that
+    # no longer exist (merged placeholders) are skipped.
+    APPEND_SQL = '''
+        WITH added AS (
+            INSERT INTO {table} (queue_id, user_id, position)
+            SELECT %(chat_id)s, new.user_id, tail.position + new.ordinality
+            FROM unnest(%(user_ids)s::bigint[]) WITH ORDINALITY AS new(user_id, ordinality)
+                 JOIN {users} u ON u.id = new.user_id,
+                 (SELECT coalesce(max(position), 0) AS position FROM {table} WHERE queue_id = %(chat_id)s) tail
+            ON CONFLICT (queue_id, user_id) DO NOTHING
+            RETURNING user_id, position
+        )
+        SELECT added.user_id, u.username, u.first_name FROM added JOIN {users} u ON u.id = added.user_id
+        ORDER BY added.position
+    '''
+
+    REMOVE_SQL = '''
+        DELETE FROM {table} WHERE queue_id = %(chat_id)s AND user_id = ANY(%(user_ids)s::bigint[])
+        RETURNING user_id
+    '''
+
+    POP_SQL = '''
+        WITH popped AS (
+            DELETE FROM {table} WHERE id = (
+                SELECT id FROM {table} WHERE queue_id = %(chat_id)s
+                ORDER BY position, id LIMIT 1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING user_id
+        )
+        SELECT popped.user_id, u.username, u.first_name FROM popped JOIN {users} u ON u.id = popped.user_id
+    '''
+
+    POSITION_SQL = '''
+        SELECT count(*) FROM {table} e, {table} me
+        WHERE me.queue_id = %(chat_id)s AND me.user_id = %(user_id)s
+          AND e.queue_id = %(chat_id)s AND (e.position, e.id) <= (me.position, me.id)
+    '''
+
+    # Entries made for placeholders of a username move to the account that
+    # turned out to own it.
+    CLAIM_SQL = '''
+        UPDATE {table} e SET user_id = %(user_id)s FROM {users} p
+        WHERE p.id < 0 AND upper(p.username) = upper(%(username)s) AND e.user_id = p.id
+          AND NOT EXISTS (SELECT 1 FROM {table} o WHERE o.queue_id = e.queue_id AND o.user_id = %(user_id)s)
+        RETURNING e.queue_id
+    '''
+
+    DROP_PLACEHOLDERS_SQL = '''
+        WITH dropped AS (
+            DELETE FROM {users} WHERE id < 0 AND upper(username) = upper(%(username)s) RETURNING id
+        )
+        DELETE FROM {table} e USING dropped WHERE e.user_id = dropped.id
+        RETURNING e.queue_id
+    '''
+
+    @classmethod
+    def append(cls, chat_id, user_ids):
+        if not user_ids:
+            return {}
+        rows = _fetchall(cls, cls.APPEND_SQL, chat_id=chat_id, user_ids=user_ids)
+        return {user_id: TelegramUser.label(username, first_name) for user_id, username, first_name in rows}
+
+    @classmethod
+    def remove(cls, chat_id, user_ids):
+        if not user_ids:
+            return set()
+        return {row[0] for row in _fetchall(cls, cls.REMOVE_SQL, chat_id=chat_id, user_ids=user_ids)}
+
+    @classmethod
+    def pop(cls, chat_id):
+        rows = _fetchall(cls, cls.POP_SQL, chat_id=chat_id)
+        return (rows[0][0], TelegramUser.label(*rows[0][1:])) if rows else None
+
+    @classmethod
+    def position_of(cls, chat_id, user_id):
+        position = _fetchall(cls, cls.POSITION_SQL, using=router.db_for_read(cls), chat_id=chat_id,
+                             user_id=user_id)[0][0]
+        return position or None
+
+    @classmethod
+    def claim(cls, user_id, username):
+        # Returns the chats whose queues changed.
+        with transaction.atomic(using=router.db_for_write(cls)):
+            moved = _fetchall(cls, cls.CLAIM_SQL, user_id=user_id, username=username)
+            dropped = _fetchall(cls, cls.DROP_PLACEHOLDERS_SQL, username=username)
+        return {row[0] for row in moved + dropped}
+
+
+class QueueAdmin(models.Model):
+    queue = models.ForeignKey(Queue, on_delete=models.CASCADE, related_name='admin_entries')
+    username = models.CharField(max_length=33)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'username'], name='bot_queueadmin_unique_username'),
+        ]
+
+    ADD_SQL = '''
+        INSERT INTO {table} (queue_id, username)
+        SELECT %(chat_id)s, new.username FROM unnest(%(usernames)s::varchar(33)[]) WITH ORDINALITY AS new(username, ordinality)
+        ORDER BY new.ordinality
+        ON CONFLICT (queue_id, username) DO NOTHING
+        RETURNING username
+    '''
+
+    REMOVE_SQL = '''
+        DELETE FROM {table} WHERE queue_id = %(chat_id)s AND username = ANY(%(usernames)s::varchar(33)[])
+        RETURNING username
+    '''
+
+    @classmethod
+    def add(cls, chat_id, usernames):
+        if not usernames:
+            return set()
+        return {row[0] for row in _fetchall(cls, cls.ADD_SQL, chat_id=chat_id, usernames=usernames)}
+
+    @classmethod
+    def remove(cls, chat_id, usernames):
+        if not usernames:
+            return set()
+        return {row[0] for row in _fetchall(cls, cls.REMOVE_SQL, chat_id=chat_id, usernames=usernames)}
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+
+class LocalCooldowns:
+    """Cooldowns kept in this process only."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id, command, cooldown):
+        now = time.monotonic()
+        key = (chat_id, command)
+        with self._lock:
+            if self._until.get(key, 0) > now:
+                return False
+            self._until[key] = now + cooldown
+            if len(self._until) > self.max_keys:
+                self._until = {k: until for k, until in self._until.items() if until > now}
+            return True
+
+
+class RedisCooldowns:
+    """Cooldowns shared through any Redis-compatible server."""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def acquire(self, chat_id, command, cooldown):
+        if cooldown <= 0:
+            return True
+        return bool(self.client.set(f'bot:cooldown:{chat_id}:{command}', 1, nx=True, px=int(cooldown * 1000)))
+
+
+class DatabaseCooldowns:
+    """Cooldowns shared through the bot_cooldown table."""
+
+    ACQUIRE_SQL = '''
+        INSERT INTO bot_cooldown (chat_id, command, expires_at)
+        VALUES (%(chat_id)s, %(command)s, now() + %(cooldown)s * interval '1 second')
+        ON CONFLICT (chat_id, command) DO UPDATE SET expires_at = EXCLUDED.expires_at
+        WHERE bot_cooldown.expires_at <= now()
+        RETURNING 1
+    '''
+
+    def acquire(self, chat_id, command, cooldown):
+        with connection.cursor() as cursor:
+            cursor.execute(self.ACQUIRE_SQL, {'chat_id': chat_id, 'command': command, 'cooldown': cooldown})
+            return cursor.fetchone() is not None
+
+
+def _create():
+    if settings.COOLDOWN_BACKEND == 'redis':
+        return RedisCooldowns(settings.REDIS_URL)
+    if settings.COOLDOWN_BACKEND == 'database':
+        return DatabaseCooldowns()
+    return LocalCooldowns()
+
+
+cooldowns = _create()
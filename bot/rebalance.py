@@ -0,0 +1,49 @@
+from django.db import transaction
+
+from bot.models import Queue
+from bot.snapshot import import_records, queue_records
+
+
+def move_chats(chat_ids, source, target):
+    """Moves the queues of chat_ids from the source to the target database
+    and returns how many were moved.
+
+    The source rows stay locked until they are deleted, so a worker still on
+    the old shard map waits instead of writing to a queue that is leaving. A
+    queue that already exists on the target is left there and only removed
+    from the source, which makes an interrupted move safe to repeat.
+    """
+    with transaction.atomic(using=source):
+        queues = Queue.objects.using(source).select_for_update().filter(chat_id__in=chat_ids)
+        moving = list(queues.values_list('chat_id', flat=True))
+        if not moving:
+            return 0
+        present = set(Queue.objects.using(target).filter(chat_id__in=moving).values_list('chat_id', flat=True))
+        remaining = Queue.objects.using(source).filter(chat_id__in=moving).exclude(chat_id__in=present)
+        records = list(queue_records(remaining))
+        if records:
+            import_records(records, using=target)
+        Queue.objects.using(source).filter(chat_id__in=moving).delete()
+    return len(moving)
+
+
+def rebalance(shard_map, batch_size=100):
+    """Moves every queue whose owner changed since shard_map.previous to its
+    new shard. Yields (source shard, queues moved so far) after each batch."""
+    for source in shard_map.previous.shards:
+        moved = 0
+        after = -2 ** 63
+        while True:
+            chat_ids = list(Queue.objects.using(source).filter(chat_id__gt=after).order_by('chat_id')
+                            .values_list('chat_id', flat=True)[:batch_size])
+            if not chat_ids:
+                break
+            after = chat_ids[-1]
+            targets = {}
+            for chat_id in chat_ids:
+                owner = shard_map.owner(chat_id)
+                if owner != source:
+                    targets.setdefault(owner, []).append(chat_id)
+            for target, moving in targets.items():
+                moved += move_chats(moving, source, target)
+            yield source, moved
@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+# Telegram's limit is 4096 UTF-16 code units per message; the rest is left
+# for the header on the first page.
+PAGE_LENGTH = 3996
+
+
+def utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+class QueueRenderer:
+    """Renders queue listings split into message-sized pages.
+
+    A page takes lines until the next one would make it longer than
+    page_length. The body of every page is cached per chat together with the
+    names it was rendered from. A page is rendered again only when its slice
+    of the queue changed, so appending a user re-renders just the last page.
+    """
+
+    def __init__(self, page_length=PAGE_LENGTH, max_chats=1000):
+        self.page_length = page_length
+        self.max_chats = max_chats
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, chat_id, is_active, users):
+        users = tuple(users)
+        with self._lock:
+            cached = self._pages.get(chat_id, [])
+        bodies = []
+        start = 0
+        while start < len(users):
+            page = cached[len(bodies)] if len(bodies) < len(cached) else None
+            if page is None or not self._still_fits(page, start, users):
+                page = self._page(start, users)
+            bodies.append(page)
+            start += len(page[0])
+
+        with self._lock:
+            self._pages[chat_id] = bodies
+            self._pages.move_to_end(chat_id)
+            if len(self._pages) > self.max_chats:
+                self._pages.popitem(last=False)
+
+        status = f'The queue is {"de" if not is_active else ""}activated'
+        status += f'. There are {len(users)} user(s) in the queue:\n' if len(users) > 0 else ' and empty.'
+        pages = [body for _, body, _ in bodies] or ['']
+        pages[0] = status + pages[0]
+        return pages
+
+    def _page(self, start, users):
+        lines = []
+        length = 0
+        for position in range(start, len(users)):
+            line = f'{position + 1}. {users[position]}\n'
+            if lines and length + utf16_length(line) > self.page_length:
+                break
+            lines.append(line)
+            length += utf16_length(line)
+        return users[start:start + len(lines)], ''.join(lines), length
+
+    def _still_fits(self, page, start, users):
+        # The cached page is what _page() would build if its names are
+        # unchanged and the line after it still does not fit.
+        names, _, length = page
+        end = start + len(names)
+        if users[start:end] != names:
+            return False
+        return end == len(users) or length + utf16_length(f'{end + 1}. {users[end]}\n') > self.page_length
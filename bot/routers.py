@@ -0,0 +1,120 @@
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from bot.sharding import current_shard
+
+# Chat of the read-only command being handled, see read_only()
+read_only_chat = ContextVar('read_only_chat', default=None)
+
+LAG_SQL = '''
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END
+'''
+
+
+class RecentWrites:
+    """When each chat's queue was last written, by this process or, through
+    the queue cache listener, by another one."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark(self, chat_id):
+        with self._lock:
+            self._written[chat_id] = time.monotonic()
+            self._written.move_to_end(chat_id)
+            if len(self._written) > self.size:
+                self._written.popitem(last=False)
+
+    def within(self, chat_id, seconds):
+        return self._written.get(chat_id, -math.inf) > time.monotonic() - seconds
+
+
+recent_writes = RecentWrites()
+
+
+def read_only(handler):
+    """Marks a command handler whose reads may be served by a replica."""
+    @functools.wraps(handler)
+    def wrapper(msg):
+        token = read_only_chat.set(msg.chat.id)
+        try:
+            return handler(msg)
+        finally:
+            read_only_chat.reset(token)
+    return wrapper
+
+
+# Tables that follow their chat to its shard. Everything else stays in the
+# default database.
+SHARDED_MODELS = {'queue', 'queueentry', 'queueadmin', 'telegramuser'}
+
+
+class ReplicaRouter:
+    """Sends the reads of read-only commands to a replica of the default
+    database.
+
+    A chat always uses the same replica, so its reads do not go back in time.
+    The primary is used instead right after the chat was written and while
+    every replica lags more than REPLICA_MAX_LAG seconds.
+    """
+
+    lag_check_interval = 1
+
+    def __init__(self):
+        self.replicas = [alias for alias in settings.DATABASES if alias.startswith('replica')]
+        self._lag = {}
+
+    def db_for_read(self, model, **hints):
+        chat_id = read_only_chat.get()
+        if (chat_id is None or not self.replicas or current_shard.get() != DEFAULT_DB_ALIAS
+                or recent_writes.within(chat_id, settings.REPLICA_MAX_LAG)):
+            return None
+        healthy = [alias for alias in self.replicas if self._lag_of(alias) <= settings.REPLICA_MAX_LAG]
+        if not healthy:
+            return None
+        return healthy[chat_id % len(healthy)]
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return False if db in self.replicas else None
+
+    def _lag_of(self, alias):
+        lag, checked = self._lag.get(alias, (None, -math.inf))
+        now = time.monotonic()
+        if checked + self.lag_check_interval < now:
+            try:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute(LAG_SQL)
+                    lag = float(cursor.fetchone()[0])
+            except DatabaseError:
+                lag = math.inf
+            self._lag[alias] = (lag, now)
+        return lag
+
+
+class ShardRouter:
+    """Keeps each chat's queue rows in the database of its shard."""
+
+    def db_for_read(self, model, **hints):
+        return current_shard.get() if model._meta.model_name in SHARDED_MODELS else None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
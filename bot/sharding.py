@@ -0,0 +1,117 @@
+import bisect
+import hashlib
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Database alias of the chat whose update is being handled, see ShardRouter
+current_shard = ContextVar('current_shard', default=DEFAULT_DB_ALIAS)
+
+
+def message_chat_id(update):
+    for message in (update.message, update.edited_message):
+        if message is not None:
+            return message.chat.id
+    return None
+
+
+class HashRing:
+    """Consistent hash of chat ids onto shards.
+
+    Every shard owns vnodes points on the ring and a chat belongs to the
+    first point after its hash. Adding a shard therefore only takes chats
+    over from the others, about 1/n of them.
+    """
+
+    def __init__(self, shards, vnodes=128):
+        self.shards = list(shards)
+        points = sorted((self._hash(f'{shard}#{i}'), shard) for shard in self.shards for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def owner(self, chat_id):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        i = bisect.bisect(self._hashes, self._hash(str(chat_id))) % len(self._hashes)
+        return self._owners[i]
+
+
+class ShardMap:
+    """Which shard, a database alias, owns each chat, and where to send the
+    updates of chats this deployment does not serve.
+
+    previous is the shard list before the last change. While it is set,
+    chats that have not been moved yet are looked up there, see
+    bot/rebalance.py.
+    """
+
+    def __init__(self, shards, previous=None, local=None, urls=None, timeout=10):
+        self.ring = HashRing(shards)
+        self.previous = HashRing(previous) if previous else None
+        self.local = set(local or shards)
+        self.urls = urls or {}
+        self.timeout = timeout
+        self.forwarded = 0
+        self.forward_failed = 0
+        self._session = None
+        self._lock = threading.Lock()
+
+    def owner(self, chat_id):
+        return self.ring.owner(chat_id) if chat_id is not None else DEFAULT_DB_ALIAS
+
+    def previous_owner(self, chat_id):
+        if self.previous is None:
+            return None
+        previous = self.previous.owner(chat_id)
+        return previous if previous != self.owner(chat_id) else None
+
+    def forward_url(self, chat_id):
+        owner = self.owner(chat_id)
+        return self.urls.get(owner) if owner not in self.local else None
+
+    def forward(self, url, body):
+        # Returns the status code to answer Telegram with
+        if self._session is None:
+            self._session = requests.Session()
+        headers = {'Content-Type': 'application/json'}
+        if settings.WEBHOOK_SECRET:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = settings.WEBHOOK_SECRET
+        try:
+            status = self._session.post(url, data=body, headers=headers, timeout=self.timeout).status_code
+        except requests.RequestException:
+            status = 502
+        with self._lock:
+            self.forwarded += 1
+            self.forward_failed += status >= 400
+        return status
+
+    @contextmanager
+    def using(self, chat_id):
+        token = current_shard.set(self.owner(chat_id))
+        try:
+            yield
+        finally:
+            current_shard.reset(token)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'shards': len(self.ring.shards),
+                'rebalancing': int(self.previous is not None),
+                'forwarded': self.forwarded,
+                'forward_failed': self.forward_failed,
+            }
+
+
+shard_map = ShardMap(getattr(settings, 'SHARDS', [DEFAULT_DB_ALIAS]),
+                     previous=getattr(settings, 'SHARDS_PREVIOUS', None),
+                     local=getattr(settings, 'SHARD_LOCAL', None),
+                     urls=getattr(settings, 'SHARD_URLS', {}))
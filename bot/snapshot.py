@@ -0,0 +1,152 @@
+import gzip
+import sys
+from itertools import groupby, islice
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.dateparse import parse_datetime, parse_time
+
+from bot.models import Queue, QueueAdmin, QueueEntry, TelegramUser
+
+try:
+    from orjson import dumps, loads
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+    loads = json.loads
+
+# One JSON object per line and per queue:
+# {"chat_id", "name", "is_active", "cooldown", "message_ids", "reset_time", "last_reset",
+#  "admins": [username, ...], "users": [[user_id, username, first_name], ...]}
+# Users are listed in queue order.
+
+
+def open_snapshot(path, mode):
+    if path == '-':
+        return (sys.stdout if 'w' in mode else sys.stdin).buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def parsed(parse, value):
+    return parse(value) if value else None
+
+
+def _grouped(rows):
+    # rows are (chat_id, value) ordered by chat_id
+    for chat_id, group in groupby(rows, key=lambda row: row[0]):
+        yield chat_id, [value for _, value in group]
+
+
+def _lookup(groups):
+    # Walks an ordered stream of groups alongside the queues
+    current = next(groups, None)
+    chat_id = yield
+    while True:
+        while current is not None and current[0] < chat_id:
+            current = next(groups, None)
+        found = current[1] if current is not None and current[0] == chat_id else []
+        chat_id = yield found
+
+
+def queue_records(queues, chunk_size=2000):
+    """Yields a snapshot record for each queue of the queryset.
+
+    Queues, entries and admins are read through three server-side cursors
+    ordered by chat id and merged as they go, so memory use does not depend on
+    the number of queues.
+    """
+    db = queues.db
+    with transaction.atomic(using=db):
+        entries = (QueueEntry.objects.using(db).filter(queue__in=queues).order_by('queue_id', 'position', 'id')
+                   .values_list('queue_id', 'user_id', 'user__username', 'user__first_name')
+                   .iterator(chunk_size=chunk_size))
+        users = _lookup(_grouped((row[0], list(row[1:])) for row in entries))
+        admins = _lookup(_grouped(QueueAdmin.objects.using(db).filter(queue__in=queues).order_by('queue_id', 'id')
+                                  .values_list('queue_id', 'username').iterator(chunk_size=chunk_size)))
+        next(users)
+        next(admins)
+
+        rows = (queues.order_by('chat_id')
+                .values_list('chat_id', 'name', 'is_active', 'cooldown', 'message_ids', 'reset_time', 'last_reset')
+                .iterator(chunk_size=chunk_size))
+        for chat_id, name, is_active, cooldown, message_ids, reset_time, last_reset in rows:
+            yield {
+                'chat_id': chat_id,
+                'name': name,
+                'is_active': is_active,
+                'cooldown': cooldown,
+                'message_ids': message_ids,
+                'reset_time': isoformat(reset_time),
+                'last_reset': isoformat(last_reset),
+                'admins': admins.send(chat_id),
+                'users': users.send(chat_id),
+            }
+
+
+def export_queues(stream, chunk_size=2000, queues=None):
+    """Writes the queues (all of them by default) to stream and returns the
+    number written."""
+    written = 0
+    for record in queue_records(queues if queues is not None else Queue.objects.all(), chunk_size):
+        stream.write(dumps(record) + b'\n')
+        written += 1
+    return written
+
+
+def import_records(queues, using=DEFAULT_DB_ALIAS):
+    """Writes snapshot records to the database in one transaction, replacing
+    queues with the same chat id."""
+    # Placeholder ids are local to the database they were exported from, so
+    # their usernames are resolved again here.
+    people = {}
+    for queue in queues:
+        for user_id, username, first_name in queue['users']:
+            people[user_id] = (username, first_name)
+    placeholders = {user_id: username for user_id, (username, _) in people.items() if user_id < 0}
+    chat_ids = [queue['chat_id'] for queue in queues]
+    with transaction.atomic(using=using):
+        resolved = TelegramUser.resolve(list(set(placeholders.values())), using=using)
+        ids = {user_id: resolved[username.upper()] for user_id, username in placeholders.items()}
+        Queue.objects.using(using).filter(chat_id__in=chat_ids).delete()
+        TelegramUser.objects.using(using).bulk_create(
+            [TelegramUser(id=user_id, username=username, first_name=first_name)
+             for user_id, (username, first_name) in people.items() if user_id > 0],
+            ignore_conflicts=True)
+        Queue.objects.using(using).bulk_create([
+            Queue(chat_id=queue['chat_id'], name=queue['name'], is_active=queue['is_active'],
+                  cooldown=queue['cooldown'], message_ids=queue['message_ids'],
+                  reset_time=parsed(parse_time, queue.get('reset_time')),
+                  last_reset=parsed(parse_datetime, queue.get('last_reset')))
+            for queue in queues
+        ])
+        QueueEntry.objects.using(using).bulk_create([
+            QueueEntry(queue_id=queue['chat_id'], user_id=ids.get(user[0], user[0]), position=position)
+            for queue in queues
+            for position, user in enumerate(queue['users'], 1)
+        ], ignore_conflicts=True)
+        QueueAdmin.objects.using(using).bulk_create([
+            QueueAdmin(queue_id=queue['chat_id'], username=username)
+            for queue in queues
+            for username in queue['admins']
+        ], ignore_conflicts=True)
+
+
+def import_queues(stream, batch_size=1000, using=DEFAULT_DB_ALIAS):
+    """Reads queues written by export_queues, replacing queues with the same
+    chat id, and returns the number imported."""
+    imported = 0
+    lines = (loads(line) for line in stream if line.strip())
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return imported
+        import_records(batch, using)
+        imported += len(batch)
@@ -0,0 +1,374 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_time
+
+from bot.cache import queue_cache
+from bot.dedup import UpdateDeduplicator, deduplicator
+from bot.models import Queue, TelegramUser
+from bot.rebalance import move_chats
+from bot.sharding import current_shard, shard_map
+from bot.snapshot import dumps, isoformat, loads, open_snapshot, parsed
+from bot.users import update_users, user_directory
+
+
+class DatabaseStorage:
+    """Queues in PostgreSQL through the Queue model, cached by queue_cache."""
+
+    def get(self, chat_id):
+        q = queue_cache.get(chat_id)
+        if q is None:
+            q = Queue.objects.filter(chat_id=chat_id).first()
+            if q is None and shard_map.previous_owner(chat_id):
+                # Not moved by the rebalance yet; bring it over now.
+                move_chats([chat_id], shard_map.previous_owner(chat_id), current_shard.get())
+                q = Queue.objects.filter(chat_id=chat_id).first()
+            if q is not None:
+                queue_cache.store(q)
+        return q
+
+    def create(self, chat_id, name, admins):
+        # get_or_create reads from the primary, so a chat that is missing on
+        # a lagging replica is not created twice.
+        q, created = Queue.objects.get_or_create(chat_id=chat_id, defaults={'name': name})
+        if created:
+            q.add_admins(admins)
+        else:
+            queue_cache.store(q)
+        return q
+
+    def remember_update(self, update):
+        user_directory.remember_update(update)
+
+    def resolve(self, usernames):
+        return user_directory.resolve(usernames)
+
+    def forget_missing(self, user_ids):
+        return user_directory.forget_missing(user_ids)
+
+    @contextmanager
+    def handling(self, update):
+        try:
+            with deduplicator.handling(update.update_id) as duplicate:
+                yield duplicate
+        except Exception:
+            # The cached queue may hold writes that were rolled back
+            queue_cache.invalidate(update.message.chat.id)
+            raise
+
+
+class MemoryQueue:
+    """A queue held by MemoryStorage, with the methods of the Queue model."""
+
+    def __init__(self, storage, chat_id, name, is_active=True, cooldown=10, message_ids=(), reset_time=None,
+                 last_reset=None):
+        self._storage = storage
+        self._lock = storage._lock
+        self.chat_id = chat_id
+        self.name = name
+        self.is_active = is_active
+        self.cooldown = cooldown
+        self.message_ids = list(message_ids)
+        self.reset_time = reset_time
+        self.last_reset = last_reset
+        self.last_active = timezone.now()
+        # User ids and admin usernames in order, as keys
+        self._entries = OrderedDict()
+        self._admins = OrderedDict()
+
+    def _set(self, **fields):
+        with self._lock:
+            for field, value in fields.items():
+                setattr(self, field, value)
+            self._storage._changed()
+        return True
+
+    @property
+    def admins(self):
+        with self._lock:
+            return list(self._admins)
+
+    def is_admin(self, username):
+        return username in self._admins
+
+    @property
+    def users(self):
+        with self._lock:
+            return [self._storage._label(user_id) for user_id in self._entries]
+
+    def user_count(self):
+        return len(self._entries)
+
+    def first_user(self):
+        with self._lock:
+            return self._storage._label(next(iter(self._entries))) if self._entries else None
+
+    def position_of(self, user_id):
+        with self._lock:
+            if user_id in self._entries:
+                for i, member in enumerate(self._entries, 1):
+                    if member == user_id:
+                        return i
+        return None
+
+    @staticmethod
+    def _add(entries, keys):
+        results = []
+        for key in keys:
+            results.append(key not in entries)
+            entries[key] = None
+        return results
+
+    @staticmethod
+    def _remove(entries, keys):
+        results = []
+        for key in keys:
+            results.append(key in entries)
+            entries.pop(key, None)
+        return results
+
+    def add_user(self, user_id):
+        return self.add_users([user_id])[0]
+
+    def remove_user(self, user_id):
+        return self.remove_users([user_id])[0]
+
+    def add_users(self, user_ids):
+        with self._lock:
+            self._storage._changed()
+            return self._add(self._entries, user_ids)
+
+    def remove_users(self, user_ids):
+        with self._lock:
+            self._storage._changed()
+            return self._remove(self._entries, user_ids)
+
+    def pop_user(self):
+        with self._lock:
+            if not self._entries:
+                return None
+            user_id, _ = self._entries.popitem(last=False)
+            self._storage._changed()
+            return self._storage._label(user_id)
+
+    def add_admin(self, username):
+        return self.add_admins([username])[0]
+
+    def remove_admin(self, username):
+        return self.remove_admins([username])[0]
+
+    def add_admins(self, usernames):
+        with self._lock:
+            self._storage._changed()
+            return self._add(self._admins, usernames)
+
+    def remove_admins(self, usernames):
+        with self._lock:
+            self._storage._changed()
+            return self._remove(self._admins, usernames)
+
+    def set_active(self, is_active):
+        with self._lock:
+            changed = self.is_active != is_active
+            self._set(is_active=is_active)
+            return changed
+
+    def clear(self):
+        with self._lock:
+            cleared = bool(self._entries)
+            self._entries.clear()
+            self._storage._changed()
+            return cleared
+
+    def set_cooldown(self, cooldown):
+        return self._set(cooldown=cooldown)
+
+    def update_message_ids(self, message_ids):
+        return self._set(message_ids=message_ids)
+
+    def set_reset_time(self, reset_time):
+        return self._set(reset_time=reset_time, last_reset=timezone.now())
+
+    def touch(self):
+        self.last_active = timezone.now()
+
+
+class MemoryStorage:
+    """Queues kept in this process only, for single-process deployments and
+    tests that run without PostgreSQL.
+
+    Commands only touch dicts. When path is set, the state is written there in
+    the exportqueues format at most once per interval seconds and at exit,
+    and read back on start.
+    """
+
+    def __init__(self, path=None, interval=5):
+        self.path = path
+        self.interval = interval
+        self._queues = {}
+        self._users = {}
+        self._ids = {}
+        self._next_placeholder = -1
+        # Changes to dicts are not rolled back, so ids need not wait for a commit
+        self._dedup = UpdateDeduplicator(size=getattr(settings, 'DEDUP_CACHE_SIZE', 10000), shared=False,
+                                         transactional=False)
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._saver = None
+        if path and os.path.exists(path):
+            self.load()
+
+    def get(self, chat_id):
+        with self._lock:
+            q = self._queues.get(chat_id)
+            if q is not None and q.reset_time is not None:
+                self._reset_if_due(q)
+            return q
+
+    def create(self, chat_id, name, admins):
+        # A queue created meanwhile by another thread is kept, as with
+        # get_or_create in DatabaseStorage.
+        with self._lock:
+            q = self._queues.get(chat_id)
+            if q is None:
+                q = self._queues[chat_id] = MemoryQueue(self, chat_id, name)
+                q.add_admins(admins)
+            return q
+
+    def remember_update(self, update):
+        for user in update_users(update):
+            self._remember(user)
+
+    def resolve(self, usernames):
+        # Usernames nobody has been seen with get placeholder ids, as in
+        # TelegramUser.resolve().
+        with self._lock:
+            ids = []
+            for username in usernames:
+                key = username.upper()
+                if key not in self._ids:
+                    self._ids[key] = self._next_placeholder
+                    self._users[self._next_placeholder] = (username, '')
+                    self._next_placeholder -= 1
+                    self._changed()
+                ids.append(self._ids[key])
+            return ids
+
+    def forget_missing(self, user_ids):
+        # Placeholders are claimed here under the lock, so ids never go stale
+        return False
+
+    def handling(self, update):
+        return self._dedup.handling(update.update_id)
+
+    def _label(self, user_id):
+        return TelegramUser.label(*self._users.get(user_id, (None, '')))
+
+    def _remember(self, user):
+        names = (user.username, user.first_name)
+        with self._lock:
+            if self._users.get(user.id) == names:
+                return
+            self._users[user.id] = names
+            if user.username:
+                owner = self._ids.get(user.username.upper())
+                self._ids[user.username.upper()] = user.id
+                if owner is not None and owner < 0:
+                    self._claim(owner, user.id)
+                elif owner is not None and owner != user.id:
+                    self._users[owner] = (None, self._users[owner][1])
+            self._changed()
+
+    def _claim(self, placeholder, user_id):
+        for q in self._queues.values():
+            if placeholder not in q._entries:
+                continue
+            if user_id in q._entries:
+                del q._entries[placeholder]
+            else:
+                q._entries = OrderedDict((user_id if member == placeholder else member, None)
+                                         for member in q._entries)
+        del self._users[placeholder]
+
+    def _reset_if_due(self, q):
+        now = timezone.now()
+        due = datetime.combine(now.date(), q.reset_time, tzinfo=now.tzinfo)
+        if due > now:
+            due -= timedelta(days=1)
+        if q.last_reset is None or q.last_reset < due:
+            q._entries.clear()
+            q.last_reset = now
+            self._changed()
+
+    def _changed(self):
+        self._dirty = True
+        if self.path and self._saver is None:
+            self._saver = threading.Thread(target=self._run, name='queue-snapshot', daemon=True)
+            self._saver.start()
+            atexit.register(self.save)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def _record(self, q):
+        return {
+            'chat_id': q.chat_id,
+            'name': q.name,
+            'is_active': q.is_active,
+            'cooldown': q.cooldown,
+            'message_ids': q.message_ids,
+            'reset_time': isoformat(q.reset_time),
+            'last_reset': isoformat(q.last_reset),
+            'admins': list(q._admins),
+            'users': [[user_id, *self._users.get(user_id, (None, ''))] for user_id in q._entries],
+        }
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            records = [self._record(q) for q in self._queues.values()]
+            self._dirty = False
+        # Written next to the snapshot and renamed over it, so a crash never
+        # leaves a half-written file behind.
+        directory, name = os.path.split(self.path)
+        temporary = os.path.join(directory, f'.{name}')
+        with open_snapshot(temporary, 'wb') as stream:
+            stream.writelines(dumps(record) + b'\n' for record in records)
+        os.replace(temporary, self.path)
+
+    def load(self):
+        with open_snapshot(self.path, 'rb') as stream, self._lock:
+            for line in stream:
+                if not line.strip():
+                    continue
+                record = loads(line)
+                q = MemoryQueue(self, record['chat_id'], record['name'], record['is_active'], record['cooldown'],
+                                record['message_ids'], parsed(parse_time, record.get('reset_time')),
+                                parsed(parse_datetime, record.get('last_reset')))
+                q._admins = OrderedDict.fromkeys(record['admins'])
+                for user_id, username, first_name in record['users']:
+                    self._users[user_id] = (username, first_name)
+                    if username and self._ids.get(username.upper(), user_id) <= user_id:
+                        self._ids[username.upper()] = user_id
+                    q._entries[user_id] = None
+                self._queues[q.chat_id] = q
+            self._next_placeholder = min(min(self._users, default=0), 0) - 1
+
+
+def _create():
+    if settings.QUEUE_BACKEND == 'memory':
+        return MemoryStorage(settings.QUEUE_SNAPSHOT, settings.QUEUE_SNAPSHOT_INTERVAL)
+    return DatabaseStorage()
+
+
+storage = _create()
@@ -1,3 +1,310 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from telebot import TeleBot, apihelper
+from telebot.types import Update
+
+from bot import bot
+from bot.coalescer import EditCoalescer
+from bot.dispatcher import REFRESH, REPLY, SendDispatcher
+from bot.loadtest import UpdateStream
+from bot.ratelimit import LocalCooldowns
+from bot.storage import MemoryQueue, MemoryStorage
+
+
+class FakeTelegramServer:
+    """A Bot API on localhost that records every call.
+
+    Calls take delay seconds to answer. The first call with a text listed in
+    rate_limited is answered with 429 and the retry_after given there, the
+    first one with a text in failing with 400.
+    """
+
+    def __init__(self, delay=0.0, rate_limited=None, failing=()):
+        self.delay = delay
+        self.rate_limited = dict(rate_limited or {})
+        self.failing = set(failing)
+        # (time, method, chat_id, text, status)
+        self.calls = []
+        self.max_in_flight = {}
+        self.max_total_in_flight = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        telegram = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # TeleBot sends the parameters in the query string
+                path, _, query = self.path.partition('?')
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, response = telegram.answer(path.rsplit('/', 1)[-1], dict(parse_qsl(query)))
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._server.server_port}/bot{{0}}/{{1}}'
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def answer(self, method, params):
+        chat_id = int(params.get('chat_id', 0))
+        text = params.get('text', '')
+        with self._lock:
+            self._in_flight[chat_id] = self._in_flight.get(chat_id, 0) + 1
+            self.max_in_flight[chat_id] = max(self.max_in_flight.get(chat_id, 0), self._in_flight[chat_id])
+            self.max_total_in_flight = max(self.max_total_in_flight, sum(self._in_flight.values()))
+        time.sleep(self.delay)
+        with self._lock:
+            self._in_flight[chat_id] -= 1
+            retry_after = self.rate_limited.pop(text, None)
+            failing = text in self.failing
+            self.failing.discard(text)
+            status = 429 if retry_after is not None else 400 if failing else 200
+            self.calls.append((time.monotonic(), method, chat_id, text, status))
+            message_id = len(self.calls)
+        if failing:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message to edit not found'}
+        if retry_after is not None:
+            return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                         'parameters': {'retry_after': retry_after}}
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                            'chat': {'id': chat_id, 'type': 'supergroup'}, 'text': text}}
+
+    def texts(self, chat_id=None, status=200):
+        with self._lock:
+            return [call[3] for call in self.calls if call[4] == status and chat_id in (None, call[2])]
+
+    def times(self, status=200):
+        with self._lock:
+            return [call[0] for call in self.calls if call[4] == status]
+
+
+class SendDispatcherTests(SimpleTestCase):
+    def start_telegram(self, **kwargs):
+        telegram = FakeTelegramServer(**kwargs)
+        telegram.start()
+        self.addCleanup(telegram.stop)
+        api_url = apihelper.API_URL
+        apihelper.API_URL = telegram.url
+        self.addCleanup(setattr, apihelper, 'API_URL', api_url)
+        return telegram
+
+    def dispatcher(self, senders=4, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000):
+        bot = TeleBot('1:test', threaded=False)
+        return SendDispatcher(lambda: bot, senders, global_rate, global_burst, chat_rate, chat_burst)
+
+    def send(self, dispatcher, chat_id, text, priority=REPLY):
+        return dispatcher.submit('send_message', chat_id, text, chat_id=chat_id, priority=priority)
+
+    def wait(self, futures):
+        return [future.result(timeout=10) for future in futures]
+
+    def test_global_bucket_paces_calls(self):
+        telegram = self.start_telegram()
+        dispatcher = self.dispatcher(global_rate=20, global_burst=1)
+        self.wait([self.send(dispatcher, chat_id, 'hi') for chat_id in range(1, 7)])
+        times = telegram.times()
+        # One call from the burst, then one every 1/20 s
+        self.assertGreaterEqual(times[-1] - times[0], 5 / 20 * 0.8)
+
+    def test_chat_bucket_paces_calls_to_one_chat(self):
+        telegram = self.start_telegram()
+        dispatcher = self.dispatcher(chat_rate=10, chat_burst=1)
+        self.wait([self.send(dispatcher, 1, str(i)) for i in range(4)])
+        times = telegram.times()
+        self.assertGreaterEqual(times[-1] - times[0], 3 / 10 * 0.8)
+        self.assertEqual(telegram.texts(1), ['0', '1', '2', '3'])
+
+    def test_replies_go_before_refreshes(self):
+        telegram = self.start_telegram()
+        dispatcher = self.dispatcher(global_rate=5, global_burst=1)
+        futures = [self.send(dispatcher, 1, 'refresh 1', REFRESH), self.send(dispatcher, 2, 'refresh 2', REFRESH),
+                   self.send(dispatcher, 3, 'reply', REPLY)]
+        self.wait(futures)
+        texts = telegram.texts()
+        self.assertLess(texts.index('reply'), texts.index('refresh 2'))
+
+    def test_one_call_in_flight_per_chat(self):
+        telegram = self.start_telegram(delay=0.05)
+        dispatcher = self.dispatcher(senders=4)
+        self.wait([self.send(dispatcher, chat_id, f'{chat_id}.{i}') for i in range(4) for chat_id in (1, 2)])
+        self.assertEqual(telegram.max_in_flight, {1: 1, 2: 1})
+        self.assertEqual(telegram.max_total_in_flight, 2)
+        self.assertEqual(telegram.texts(1), ['1.0', '1.1', '1.2', '1.3'])
+
+    def test_rate_limited_call_is_requeued_after_retry_after(self):
+        telegram = self.start_telegram(rate_limited={'first': 1})
+        dispatcher = self.dispatcher()
+        first = self.send(dispatcher, 1, 'first')
+        second = self.send(dispatcher, 1, 'second')
+        other = self.send(dispatcher, 2, 'other')
+        sent = self.wait([first, second, other])
+
+        self.assertEqual(sent[0].text, 'first')
+        self.assertEqual(telegram.texts(1), ['first', 'second'])
+        # The other chat is not held up by the 429
+        self.assertEqual(telegram.texts(2), ['other'])
+        limited_at = telegram.times(status=429)[0]
+        resent_at = telegram.times()[telegram.texts().index('first')]
+        self.assertGreaterEqual(resent_at - limited_at, 0.9)
+        self.assertEqual(dispatcher.stats()['rate_limited'], 1)
+
+    def test_handlers_do_not_wait_for_callbacks(self):
+        self.start_telegram()
+        dispatcher = self.dispatcher(chat_rate=1, chat_burst=1)
+        sent = []
+        done = threading.Event()
+        with mock.patch.object(bot, 'dispatcher', dispatcher):
+            self.send(dispatcher, 1, 'first')
+            started = time.monotonic()
+            bot._send('send_message', 1, 'second', chat_id=1, callback=lambda m: (sent.append(m.text), done.set()))
+            # The chat's bucket holds 'second' back for about a second
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertTrue(done.wait(5))
+        self.assertEqual(sent, ['second'])
+
+    def coalescer(self, dispatcher):
+        def edit(text, chat_id, message_id):
+            return dispatcher.submit('edit_message_text', text, chat_id, message_id, chat_id=chat_id,
+                                     priority=REFRESH)
+        return EditCoalescer(edit, window=0.01)
+
+    def wait_for_edits(self, coalescer, count):
+        deadline = time.monotonic() + 10
+        while coalescer.stats()['sent'] + coalescer.stats()['failed'] < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_coalesced_edit_is_retried_by_the_dispatcher(self):
+        self.start_telegram(rate_limited={'list': 1})
+        dispatcher = self.dispatcher()
+        coalescer = self.coalescer(dispatcher)
+        coalescer._send(1, 10, 'list')
+        self.wait_for_edits(coalescer, 1)
+        self.assertEqual(dispatcher.stats()['rate_limited'], 1)
+        self.assertEqual((coalescer.stats()['sent'], coalescer.stats()['failed']), (1, 0))
+
+    def test_failed_edit_is_not_remembered(self):
+        telegram = self.start_telegram(failing={'list'})
+        dispatcher = self.dispatcher()
+        coalescer = self.coalescer(dispatcher)
+        for count in (1, 2):
+            coalescer._send(1, 10, 'list')
+            self.wait_for_edits(coalescer, count)
+        # The second, identical text is sent because the first edit failed
+        self.assertEqual(telegram.texts(status=400) + telegram.texts(), ['list', 'list'])
+        self.assertEqual(coalescer.stats()['failed'], 1)
+        coalescer._send(1, 10, 'list')
+        self.assertEqual(coalescer.stats()['skipped'], 1)
+
+
+@override_settings(QUEUE_BACKEND='memory', TRUST_CHAT_ADMINS=False, BOT_USERNAME=None)
+class MemoryBackendHandlerTests(SimpleTestCase):
+    """Commands handled end to end on MemoryStorage, without a database."""
+
+    CHAT_ID = -100
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        for name, value in (('storage', self.storage), ('cooldowns', LocalCooldowns())):
+            patcher = mock.patch.object(bot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.stream = UpdateStream(0, seed=1)
+        # The first user to talk to the bot in a chat becomes its admin
+        self.handle('admin', '/admins')
+
+    def message(self, username, text, mentions=()):
+        return self.stream.message(self.CHAT_ID, username, text, mentions)
+
+    def handle(self, username_or_update, text=None, mentions=()):
+        """Handles an update and returns the texts of the replies it sent."""
+        update = username_or_update
+        if text is not None:
+            update = self.message(username_or_update, text, mentions)
+        outbox = []
+        token = bot._outbox.set(outbox)
+        try:
+            bot.process_update(Update.de_json(json.dumps(update)))
+        finally:
+            bot._outbox.reset(token)
+        return [args[1] for method, args, *_ in outbox if method == 'reply_to']
+
+    def queue(self):
+        return self.storage.get(self.CHAT_ID)
+
+    def test_enter_leave_and_where(self):
+        self.assertEqual(self.handle('alice', '/enter'), ['You are now in the queue! Your position is 1.'])
+        self.assertEqual(self.handle('bob', '/enter'), ['You are now in the queue! Your position is 2.'])
+        self.assertEqual(self.handle('alice', '/enter'), ['You are already in the queue.'])
+        self.assertEqual(self.handle('alice', '/leave'), ['You have successfully left the queue'])
+        self.assertEqual(self.handle('bob', '/where'), ['Your position is 1'])
+        self.assertEqual(self.handle('carol', '/who'), ['@bob is the first.'])
+
+    def test_deactivated_queue_only_admits_admins(self):
+        self.handle('admin', '/deactivate')
+        self.assertEqual(self.handle('alice', '/enter'), ['Queue is deactivated. Only admins can add new people.'])
+        self.assertEqual(self.handle('admin', '/enter'), ['You are now in the queue! Your position is 1.'])
+
+    def test_admin_commands_need_admin_rights(self):
+        self.assertEqual(self.handle('alice', '/reset'), ['You must have admin permissions for this action.'])
+        self.handle('admin', '/promote @alice', ['alice'])
+        self.assertEqual(self.handle('alice', '/reset'), ['Queue reset.'])
+
+    def test_added_username_is_claimed_by_its_user(self):
+        self.assertEqual(self.handle('admin', '/add @carol @dave', ['carol', 'dave']),
+                         ['Successfully added everybody mentioned.'])
+        self.assertEqual(self.queue().users, ['@carol', '@dave'])
+        # carol was mentioned before the bot saw her; her first message
+        # replaces the placeholder with her user id.
+        self.assertEqual(self.handle('carol', '/where'), ['Your position is 1'])
+        self.assertEqual(self.handle('carol', '/enter'), ['You are already in the queue.'])
+        self.assertEqual(self.handle('admin', '/pop'), ['@carol is now not in the queue.'])
+
+    def test_redelivered_update_is_handled_once(self):
+        update = self.message('alice', '/enter')
+        self.assertEqual(len(self.handle(update)), 1)
+        self.assertEqual(self.handle(update), [])
+
+    def test_failed_update_runs_again_when_retried(self):
+        update = self.message('alice', '/enter')
+        with mock.patch.object(MemoryQueue, 'add_user', side_effect=RuntimeError('transient')):
+            with self.assertRaises(RuntimeError):
+                self.handle(update)
+        self.assertEqual(self.handle(update), ['You are now in the queue! Your position is 1.'])
+        self.assertEqual(self.queue().user_count(), 1)
+
+    def test_schedule_does_not_clear_the_queue_at_once(self):
+        self.handle('alice', '/enter')
+        self.handle('bob', '/enter')
+        reset_at = datetime.now(timezone.utc).replace(second=0, microsecond=0).time()
+        self.assertEqual(self.handle('admin', f'/schedule {reset_at:%H:%M}'),
+                         [f'The queue will be reset every day at {reset_at:%H:%M} UTC.'])
+        self.assertEqual(self.handle('carol', '/who'), ['@alice is the first.'])
+
+    def test_concurrent_creates_keep_one_queue(self):
+        q = self.storage.create(-200, 'Chat', ['admin'])
+        q.add_user(1)
+        self.assertIs(self.storage.create(-200, 'Chat', ['other']), q)
+        self.assertEqual(q.user_count(), 1)
+        self.assertEqual(q.admins, ['admin'])
@@ -1,7 +1,15 @@
+from django.conf import settings
 from django.urls import path
 
-from bot.views import webhook
+if settings.BOT_ASYNC:
+    from bot.async_views import webhook
+else:
+    from bot.views import webhook
 
-urlpatterns = [
-    path('<token>', webhook, name='webhook')
-]
+urlpatterns = []
+
+if settings.METRICS_ENABLED:
+    from bot.fast_views import metrics
+    urlpatterns.append(path('metrics', metrics, name='metrics'))
+
+urlpatterns.append(path('<token>', webhook, name='webhook'))
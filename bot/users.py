@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from bot.cache import queue_cache
+from bot.models import QueueEntry, TelegramUser
+from bot.sharding import current_shard
+
+
+def update_users(update):
+    # The sender of a message and the users it mentions by id
+    message = update.message or update.edited_message
+    if message is None:
+        return
+    if message.from_user is not None:
+        yield message.from_user
+    for entity in message.entities or ():
+        if entity.type == 'text_mention':
+            yield entity.user
+
+
+class UserDirectory:
+    """Telegram users seen by the bot, and the ids behind their usernames.
+
+    Every update is passed to remember_update(), which writes a TelegramUser
+    row only when the user is new to this process or changed their name.
+    resolve() answers mentions from memory and goes to the database only for
+    usernames it has not looked up within ttl seconds. Every shard has its own
+    TelegramUser table, so entries are kept per shard.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._seen = OrderedDict()
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember_update(self, update):
+        for user in update_users(update):
+            self.remember(user)
+
+    def remember(self, user):
+        names = (user.username, user.first_name)
+        shard = current_shard.get()
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get((shard, user.id))
+            if seen is not None and seen[0] == names and seen[1] > now:
+                self._seen.move_to_end((shard, user.id))
+                return
+
+        changed = TelegramUser.record(user.id, user.username, user.first_name)
+        if changed and user.username:
+            for chat_id in QueueEntry.claim(user.id, user.username):
+                queue_cache.invalidate(chat_id)
+        with self._lock:
+            self.writes += changed
+            self._put(self._seen, (shard, user.id), names, now)
+            if user.username:
+                self._put(self._ids, (shard, user.username.upper()), user.id, now)
+
+    def resolve(self, usernames):
+        """Returns the user id for each username, in the same order."""
+        shard = current_shard.get()
+        ids = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in {username.upper() for username in usernames}:
+                entry = self._ids.get((shard, key))
+                if entry is not None and entry[1] > now:
+                    self._ids.move_to_end((shard, key))
+                    ids[key] = entry[0]
+            self.hits += len(ids)
+
+        missing = [username for username in usernames if username.upper() not in ids]
+        if missing:
+            found = TelegramUser.resolve(missing)
+            ids.update(found)
+            with self._lock:
+                self.misses += len(found)
+                for key, user_id in found.items():
+                    self._put(self._ids, (shard, key), user_id, now)
+        return [ids[username.upper()] for username in usernames]
+
+    def forget_missing(self, user_ids):
+        """Evicts placeholder ids that no longer exist, because another worker
+        saw their user or compactqueues dropped them, and tells whether there
+        were any."""
+        placeholders = {user_id for user_id in user_ids if user_id < 0}
+        if not placeholders:
+            return False
+        gone = placeholders - set(TelegramUser.objects.filter(id__in=placeholders).values_list('id', flat=True))
+        if gone:
+            with self._lock:
+                for key in [key for key, entry in self._ids.items() if entry[0] in gone]:
+                    del self._ids[key]
+        return bool(gone)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._ids),
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+            }
+
+    def _put(self, entries, key, value, now):
+        entries[key] = (value, now + self.ttl)
+        entries.move_to_end(key)
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+
+
+user_directory = UserDirectory(size=getattr(settings, 'USER_CACHE_SIZE', 10000),
+                               ttl=getattr(settings, 'USER_CACHE_TTL', 300))
@@ -1,20 +1,35 @@
+import json
 import os
 import telebot
+from django.conf import settings
+from django.http import HttpResponseForbidden
 from rest_framework.decorators import api_view
 from rest_framework.views import Response
-from bot.bot import bot
+from bot.bot import get_bot, process_update
+from bot.fast_views import has_secret
+from bot.ingest import ingest_pool
+from bot.sharding import message_chat_id, shard_map
 
 
 @api_view(['GET', 'POST'])
 def webhook(request, token):
     if request.method == 'GET':
         try:
-            bot.remove_webhook()
-            bot.set_webhook(f"{os.getenv('APP_URL')}/{token}")
+            get_bot().remove_webhook()
+            get_bot().set_webhook(f"{os.getenv('APP_URL')}/{token}", secret_token=settings.WEBHOOK_SECRET or None)
             return Response('Webhook was successfully set.')
         except Exception as e:
             return Response(str(e))
 
     elif request.method == 'POST':
-        bot.process_new_updates([telebot.types.Update.de_json(request.data)])
+        if not has_secret(request):
+            return HttpResponseForbidden()
+        update = telebot.types.Update.de_json(request.data)
+        url = shard_map.forward_url(message_chat_id(update))
+        if url is not None:
+            return Response(status=shard_map.forward(url, json.dumps(request.data)))
+        if not settings.WEBHOOK_INGEST:
+            process_update(update)
+        elif not ingest_pool.submit(update):
+            return Response('Too many updates.', status=503)
         return Response('!')
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 
+import dj_database_url
 import django_heroku
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -54,7 +55,7 @@ WSGI_APPLICATION = 'botnet.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'django.db.backends.postgresql',
         'NAME': 'telebot',
         'USER': 'jiklopo',
         'PASSWORD': 'kartop',
@@ -63,6 +64,69 @@ DATABASES = {
     }
 }
 
+# Per-process cache of queue state, see bot/cache.py
+QUEUE_CACHE_SIZE = int(os.getenv('QUEUE_CACHE_SIZE') or 1000)
+QUEUE_CACHE_TTL = int(os.getenv('QUEUE_CACHE_TTL') or 60)
+QUEUE_CACHE_LISTEN = os.getenv('QUEUE_CACHE_LISTEN', '1') == '1'
+
+# Seconds to wait for more changes before editing the queue list message
+EDIT_DEBOUNCE = float(os.getenv('EDIT_DEBOUNCE') or 1)
+
+# Outgoing Telegram calls, see bot/dispatcher.py. Rates are in calls per second.
+TELEGRAM_SENDERS = int(os.getenv('TELEGRAM_SENDERS') or 4)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE') or 30)
+TELEGRAM_GLOBAL_BURST = int(os.getenv('TELEGRAM_GLOBAL_BURST') or 30)
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE') or 20 / 60)
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST') or 10)
+TELEGRAM_SESSION_TTL = int(os.getenv('TELEGRAM_SESSION_TTL') or 600)
+
+# Expose Prometheus metrics at /metrics and log updates slower than SLOW_UPDATE_SECONDS
+METRICS_ENABLED = os.getenv('METRICS_ENABLED') == '1'
+SLOW_UPDATE_SECONDS = float(os.getenv('SLOW_UPDATE_SECONDS') or 0)
+
+# Also give queue admin rights to the chat's Telegram administrators, whose
+# list is fetched at most once per CHAT_ADMINS_TTL seconds per chat
+TRUST_CHAT_ADMINS = os.getenv('TRUST_CHAT_ADMINS') == '1'
+CHAT_ADMINS_TTL = int(os.getenv('CHAT_ADMINS_TTL') or 300)
+
+# The bot's username; commands addressed to other bots (/queue@OtherBot) are
+# ignored when it is set
+BOT_USERNAME = os.getenv('BOT_USERNAME')
+
+# Commands whose update_id was already handled are dropped. The last
+# DEDUP_CACHE_SIZE ids are kept in memory; DEDUP_SHARED=1 also records them in
+# the database so that redeliveries to another worker are caught.
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE') or 10000)
+DEDUP_SHARED = os.getenv('DEDUP_SHARED', '1') == '1'
+
+# Per-process cache of username -> user id lookups, see bot/users.py
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE') or 10000)
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL') or 300)
+
+# Where queues are kept: 'database' (PostgreSQL) or 'memory' (this process
+# only, for a single worker or tests). The memory backend is saved to
+# QUEUE_SNAPSHOT, when set, every QUEUE_SNAPSHOT_INTERVAL seconds.
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND') or 'database'
+QUEUE_SNAPSHOT = os.getenv('QUEUE_SNAPSHOT')
+QUEUE_SNAPSHOT_INTERVAL = float(os.getenv('QUEUE_SNAPSHOT_INTERVAL') or 5)
+
+# Where command cooldowns are kept: 'local' (this process), 'redis' (needs the redis package) or 'database'
+COOLDOWN_BACKEND = os.getenv('COOLDOWN_BACKEND') or 'local'
+REDIS_URL = os.getenv('REDIS_URL') or 'redis://localhost:6379/0'
+
+# Serve the webhook with bot/async_bot.py, requires running under botnet.asgi
+BOT_ASYNC = os.getenv('BOT_ASYNC') == '1'
+
+# Telegram sends this in X-Telegram-Bot-Api-Secret-Token; requests without it are refused
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or ''
+
+# Acknowledge webhooks at once and process updates on background workers, see bot/ingest.py
+WEBHOOK_INGEST = os.getenv('WEBHOOK_INGEST') == '1'
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS') or 4)
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE') or 1000)
+INGEST_DRAIN_TIMEOUT = int(os.getenv('INGEST_DRAIN_TIMEOUT') or 20)
+INGEST_SLOW_SECONDS = int(os.getenv('INGEST_SLOW_SECONDS') or 5)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -94,4 +158,48 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 STATIC_URL = '/static/'
-django_heroku.settings(locals())
\ No newline at end of file
+django_heroku.settings(locals())
+
+# Database connection reuse, see bot/db.py for the matching metrics.
+# Sync workers keep their connection for DB_CONN_MAX_AGE seconds and check it
+# before reuse. For pooling across workers put PgBouncer in front of the
+# database: DB_PGBOUNCER=1 makes the connections safe in transaction mode;
+# set QUEUE_CACHE_LISTEN=0 there as well, or point DATABASES at PostgreSQL
+# directly for the listener.
+DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE') or 60)
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+if os.getenv('DB_PGBOUNCER') == '1':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Read replicas for read-only commands (comma-separated database URLs), see
+# bot/routers.py. A replica is skipped while it lags more than
+# REPLICA_MAX_LAG seconds, and a chat reads from the primary for that long
+# after its own last write.
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG') or 2)
+
+
+def _database_at(url, **extra):
+    # The primary's connection options, only the server taken from url
+    parsed = dj_database_url.parse(url.strip())
+    return dict(DATABASES['default'], **{key: parsed[key] for key in ('NAME', 'USER', 'PASSWORD', 'HOST', 'PORT')},
+                **extra)
+
+
+for i, url in enumerate(filter(None, (os.getenv('DATABASE_REPLICA_URLS') or '').split(','))):
+    DATABASES[f'replica{i + 1}'] = _database_at(url, TEST={'MIRROR': 'default'})
+
+# Chat sharding, see bot/sharding.py. SHARD_DATABASE_URLS adds the databases
+# shard1, shard2, ... and SHARDS lists the aliases chats are spread over.
+# After changing SHARDS, keep the old list in SHARDS_PREVIOUS until
+# `manage.py rebalance` has finished. SHARD_LOCAL lists the shards this
+# deployment serves (all by default); updates of other shards' chats are
+# forwarded to their webhook in SHARD_URLS (alias=url,...).
+for i, url in enumerate(filter(None, (os.getenv('SHARD_DATABASE_URLS') or '').split(','))):
+    DATABASES[f'shard{i + 1}'] = _database_at(url)
+SHARDS = (os.getenv('SHARDS') or 'default').split(',')
+SHARDS_PREVIOUS = os.getenv('SHARDS_PREVIOUS', '').split(',') if os.getenv('SHARDS_PREVIOUS') else None
+SHARD_LOCAL = os.getenv('SHARD_LOCAL', '').split(',') if os.getenv('SHARD_LOCAL') else None
+SHARD_URLS = dict(pair.split('=', 1) for pair in filter(None, (os.getenv('SHARD_URLS') or '').split(',')))
+
+if len(DATABASES) > 1:
+    DATABASE_ROUTERS = ['bot.routers.ReplicaRouter', 'bot.routers.ShardRouter']
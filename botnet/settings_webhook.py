@@ -0,0 +1,18 @@
+# Settings for a process that only serves the Telegram webhook:
+#
+#     DJANGO_SETTINGS_MODULE=botnet.settings_webhook gunicorn botnet.wsgi
+#
+# The admin, sessions, auth, messages and DRF are not loaded and no middleware
+# runs. Use botnet.settings for migrations and the admin site.
+from botnet.settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'bot',
+]
+
+MIDDLEWARE = []
+
+ROOT_URLCONF = 'botnet.urls_webhook'
+
+TEMPLATES = []
@@ -0,0 +1,11 @@
+from django.conf import settings
+from django.urls import path
+
+from bot.fast_views import metrics, webhook
+
+urlpatterns = []
+
+if settings.METRICS_ENABLED:
+    urlpatterns.append(path('metrics', metrics, name='metrics'))
+
+urlpatterns.append(path('<token>', webhook, name='webhook'))
@@ -10,7 +10,12 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'botnet.settings')
 
 application = get_wsgi_application()
+
+# Import the URLconf and the views now instead of on the first request, so
+# that the first webhook after a restart does not time out.
+get_resolver().url_patterns
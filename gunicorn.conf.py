@@ -0,0 +1,10 @@
+# Import Django, the URLconf and the handlers once in the master process and
+# share them with the forked workers, see botnet/wsgi.py.
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # Database connections opened while preloading must not be inherited by
+    # the workers, so close them before every fork.
+    from django.db import connections
+    connections.close_all()